@@ -2,13 +2,15 @@ import os
 import log
 from xml.etree.cElementTree import ElementTree, Element, SubElement, tostring, iterparse
 import cPickle as pickle
-import gzip
 import time
-import random
+import mirrors
+import compression
 
 # User selection stored here, so it goes into a user settings backup
 SETTINGS_FILE = '/etc/enigma2/epgimport.conf'
 
+CUSTOM_CHANNELS = '/etc/epgimport/custom.channels.xml'
+
 channelCache = {}
 
 def isLocalFile(filename):
@@ -45,25 +47,24 @@ class EPGChannel:
 		else:
 			self.urls = urls
 		self.items = None
+		# the channels of the last read channel file, without the custom ones
+		self.fileItems = {}
+		self.filterKey = None
 	def openStream(self, filename):
-		fd = open(filename, 'rb')
-		if not os.fstat(fd.fileno()).st_size:
+		if not os.path.getsize(filename):
 			raise Exception, "File is empty"
-		if filename.endswith('.gz'):
-			fd = gzip.GzipFile(fileobj = fd, mode = 'rb')
-		elif filename.endswith('.xz') or filename.endswith('.lzma'):
-			try:
-				import lzma
-			except ImportError:
-				from backports import lzma
-			fd = lzma.open(filename, 'rb')
-		return fd
-	def parse(self, filterCallback, downloadedFile):
-		print>>log,"[EPGImport] Parsing channels from '%s'" % self.name
-		if self.items is None:
-			self.items = {}
+		return compression.openFile(filename)
+	def parse(self, filterCallback, downloadedFile, items):
+		'''Adds the channels of downloadedFile that pass filterCallback to items.
+		True when all were read and filterCallback was sure about all of them,
+		it returns None for a channel it may pass another time.'''
+		print>>log,"[EPGImport] Parsing channels from '%s'" % downloadedFile
+		complete = False
+		final = True
+		fd = None
 		try:
-			context = iterparse(self.openStream(downloadedFile))
+			fd = self.openStream(downloadedFile)
+			context = iterparse(fd)
 			for event, elem in context:
 				if elem.tag == 'channel':
 					id = elem.get('id')
@@ -71,30 +72,68 @@ class EPGChannel:
 					ref = elem.text
 					if id and ref:
 						ref = ref.encode('latin-1')
-						if filterCallback(ref):
-							if self.items.has_key(id):
-								self.items[id].append(ref)
+						verdict = filterCallback(ref)
+						if verdict:
+							if items.has_key(id):
+								items[id].append(ref)
 							else:
-								self.items[id] = [ref]
+								items[id] = [ref]
+						elif verdict is None:
+							final = False
 					elem.clear()
+			complete = final
 		except Exception as e:
 			print>>log, "[EPGImport] failed to parse", downloadedFile, "Error:", e
 			pass
-	def update(self, filterCallback, downloadedFile=None):
-		customFile='/etc/epgimport/custom.channels.xml'
+		if fd is not None:
+			fd.close()
+		return complete
+	def read(self, filterCallback, filename, index=None, filterKey=None):
+		'''The channels of filename that pass filterCallback. With an index
+		(see channelindex.py) and a filterKey that stands for everything the
+		filter depends on, a map read before is used instead.
+		Returns the map and whether it is final, see parse.'''
+		key = None
+		if (index is not None) and (filterKey is not None):
+			key = index.key(filename, filterKey)
+			if key is not None:
+				items = index.load(key)
+				if items is not None:
+					print>>log,"[EPGImport] Channels of '%s' from the index" % filename
+					return items, True
+		items = {}
+		complete = self.parse(filterCallback, filename, items)
+		if complete and (key is not None):
+			index.store(key, items)
+		return items, complete
+	def update(self, filterCallback, downloadedFile=None, index=None, filterKey=None):
+		customFile = CUSTOM_CHANNELS
 		# Always read custom file since we don't know when it was last updated
 		# and we don't have multiple download from server problem since it is always a local file.
 		if os.path.exists(customFile):
-			print>>log,"[EPGImport] Parsing channels from '%s'" % customFile
-			self.parse(filterCallback, customFile)
+			custom, complete = self.read(filterCallback, customFile, index, filterKey)
+		else:
+			custom = {}
 		if downloadedFile is not None:
 			self.mtime = time.time()
-			return self.parse(filterCallback, downloadedFile)
+			self.fileItems, complete = self.read(filterCallback, downloadedFile, index, filterKey)
+			self.filterKey = filterKey
 		elif (len(self.urls) == 1) and isLocalFile(self.urls[0]):
 			mtime = os.path.getmtime(self.urls[0])
-			if (not self.mtime) or (self.mtime < mtime):
-				self.parse(filterCallback, self.urls[0])
-				self.mtime = mtime
+			if (not self.mtime) or (self.mtime < mtime) or (filterKey != self.filterKey):
+				self.fileItems, complete = self.read(filterCallback, self.urls[0], index, filterKey)
+				# Read again next time when the filter was not sure about some channels
+				self.mtime = complete and mtime or None
+				self.filterKey = filterKey
+		# Custom channels first, then those of the channel file
+		self.items = {}
+		for channels in (custom, self.fileItems):
+			for id, refs in channels.iteritems():
+				known = self.items.get(id)
+				if known is None:
+					self.items[id] = list(refs)
+				else:
+					known.extend([ref for ref in refs if ref not in known])
 	def downloadables(self):
 		if (len(self.urls) == 1) and isLocalFile(self.urls[0]):
 			return None
@@ -118,7 +157,7 @@ class EPGSource:
 		else:
 			self.nocheck = 0
 		self.urls = [e.text.strip() for e in elem.findall('url')]
-		self.url = random.choice(self.urls)
+		self.url = mirrors.choose(self.urls)
 		self.description = elem.findtext('description')
 		self.category = category
 		if not self.description:
@@ -8,32 +8,56 @@ import time
 import os
 import gzip
 import log
-import random
-from twisted import version
-from sys import version_info
-from socket import getaddrinfo, AF_INET6, has_ipv6
+import tempfile
+from hashlib import sha1
 
 HDD_EPG_DAT = "/hdd/epg.dat"
 
-from twisted.internet import reactor, threads
-from twisted.web.client import downloadPage
+from twisted.internet import reactor, threads, defer, task
+from twisted.web.error import Error as WebError
+from twisted.python.failure import Failure
 import twisted.python.runtime
-
-import urllib2, httplib
-from datetime import datetime
-
-# Used to check server validity
-date_format = "%Y-%m-%d"
-now = datetime.now()
-alloweddelta = 2
-CheckFile = "LastUpdate.txt"
-ServerStatusList = {}
+import httpdownload
+import downloadcache
+import compression
+import stream
+import mirrors
+import mirrorrace
+import staging
+import sharding
+import xmltvconverter
+import grouping
+from eventbuffer import EventBuffer
+import parsecache
+import channelindex
+import snapshot
+
+import servercheck
+
+# Number of source downloads allowed to run ahead of the parser
+PREFETCH_DEPTH = 2
+
+# Number of mirrors a source download is raced on, 0 or 1 to disable
+RACE_MIRRORS = 0
+
+# Times a broken download is resumed from the same mirror before moving on
+RESUME_ATTEMPTS = 2
+
+# The download cache only lives on real disks, never in RAM
+CACHE_LOCATIONS = ('/media/hdd', '/media/usb', '/media/mmc', '/media/cf')
+CACHE_MIN_FREE = 200000000
+
+# Parser processes for big XMLTV files, 1 parses in the importing thread
+PARSE_WORKERS = 1
 
 PARSERS = {
 	'xmltv': 'gen_xmltv',
 	'genxmltv': 'gen_xmltv',
 }
 
+# Parsers that can read the chunks of sharding.splitProgrammes
+SHARDED_PARSERS = ('gen_xmltv',)
+
 def relImport(name):
 	fullname = __name__.split('.')
 	fullname[-1] = name
@@ -53,28 +77,6 @@ def getTimeFromHourAndMinutes(hour, minute):
 						hour, minute, 0, now.tm_wday, now.tm_yday, now.tm_isdst)))
 	return begin
 
-def bigStorage(minFree, default, *candidates):
-	try:
-		diskstat = os.statvfs(default)
-		free = diskstat.f_bfree * diskstat.f_bsize
-		if (free > minFree) and (free > 50000000):
-			return default
-	except Exception, e:
-		print>>log, "[EPGImport] Failed to stat %s:" % default, e
-	mounts = open('/proc/mounts', 'rb').readlines()
-	# format: device mountpoint fstype options #
-	mountpoints = [x.split(' ', 2)[1] for x in mounts]
-	for candidate in candidates:
-		if candidate in mountpoints:
-			try:
-				diskstat = os.statvfs(candidate)
-				free = diskstat.f_bfree * diskstat.f_bsize
-				if free > minFree:
-					return candidate
-			except:
-				pass
-	return default
-
 class OudeisImporter:
 	'Wrapper to convert original patch to new one that accepts multiple services'
 	def __init__(self, epgcache):
@@ -85,6 +87,55 @@ class OudeisImporter:
 		for service in services:
 			self.epgcache.importEvent(service, events)
 
+def useThreads():
+	return twisted.python.runtime.platform.supportsThreads() and os.path.exists("/var/lib/opkg/status")
+
+def isRemote(filename):
+	return filename.startswith('http:') or filename.startswith('ftp:')
+
+class Prefetch:
+	'A source download running ahead of the parser, handed over once both sides are ready'
+	def __init__(self):
+		self.result = None
+		self.handlers = None
+		self.cancelled = False
+	def done(self, result, filename, deleteFile=True):
+		if self.cancelled:
+			if deleteFile:
+				unlink_if_exists(filename)
+			return
+		self.result = (True, (filename, deleteFile))
+		self.fire()
+	def failed(self, failure):
+		if self.cancelled:
+			return
+		self.result = (False, failure)
+		self.fire()
+	def ready(self):
+		return self.result is not None
+	def attach(self, afterDownload, downloadFail):
+		self.handlers = (afterDownload, downloadFail)
+		self.fire()
+	def fire(self):
+		if (self.result is None) or (self.handlers is None):
+			return
+		success, value = self.result
+		afterDownload, downloadFail = self.handlers
+		# Handed over, the file belongs to the receiver now
+		self.result = self.handlers = None
+		if success:
+			afterDownload(None, *value)
+		else:
+			downloadFail(value)
+	def cancel(self):
+		self.cancelled = True
+		self.handlers = None
+		if self.result is not None:
+			success, value = self.result
+			if success and value[1]:
+				unlink_if_exists(value[0])
+			self.result = None
+
 def unlink_if_exists(filename):
 	if filename.endswith("epg.db"):
 		return
@@ -98,8 +149,11 @@ class EPGImport:
 
 	def __init__(self, epgcache, channelFilter):
 		self.eventCount = None
+		# events that could not be written, see closeImport
+		self.storeErrors = 0
 		self.epgcache = None
 		self.storage = None
+		self.grouping = None
 		self.sources = []
 		self.source = None
 		self.epgsource = None
@@ -108,58 +162,64 @@ class EPGImport:
 		self.onDone = None
 		self.epgcache = epgcache
 		self.channelFilter = channelFilter
+		self.prefetchDepth = PREFETCH_DEPTH
+		self.prefetched = {}
+		self.downloadCache = None
+		self.parseCache = None
+		self.snapshot = None
+		self.channelIndex = None
+		# Stands for all the channelFilter depends on, None disables the channel index
+		self.channelFilterKey = None
+		# (new, changed, removed, unchanged) events of the last import
+		self.differences = None
+		self.sourceFile = None
+		self.window = None
+		self.streamDownloads = True
+		self.stream = None
+		self.raceMirrors = RACE_MIRRORS
+		self.parseWorkers = PARSE_WORKERS
+		self.validating = False
+		self.partials = []
+		self.channelFetch = None
 
 	def checkValidServer(self, serverurl):
-		dirname, filename = os.path.split(serverurl)
-		FullString = dirname + "/" + CheckFile
-		req = urllib2.build_opener()
-		req.addheaders = [('User-Agent', 'Twisted Client')]
-		dlderror=0
-		if ServerStatusList.has_key(dirname):
-			# If server is know return its status immediately
-			return ServerStatusList[dirname]
-		else:
-			# Server not in the list so checking it
-			try:
-				response = req.open(FullString)
-			except urllib2.HTTPError, e:
-				print ('[EPGImport] HTTPError in checkValidServer= ' + str(e.code))
-				dlderror=1
-			except urllib2.URLError, e:
-				print ('[EPGImport] URLError in checkValidServer= ' + str(e.reason))
-				dlderror=1
-			except httplib.HTTPException, e:
-				print ('[EPGImport] HTTPException in checkValidServer')
-				dlderror=1
-			except Exception:
-				print ('[EPGImport] Generic exception in checkValidServer')
-				dlderror=1
-
-			if not dlderror:
-				LastTime = response.read().strip('\n')
-				try:
-					FileDate = datetime.strptime(LastTime, date_format)
-				except ValueError:
-					print>>log, "[EPGImport] checkValidServer wrong date format in file rejecting server %s" % dirname
-					ServerStatusList[dirname]=0
-					return ServerStatusList[dirname]
-				delta = (now - FileDate).days
-				if delta <= alloweddelta:
-					# OK the delta is in the foreseen windows
-					ServerStatusList[dirname]=1
-				else:
-					# Sorry the delta is higher removing this site
-					print>>log, "[EPGImport] checkValidServer rejected server delta days too high: %s" % dirname
-					ServerStatusList[dirname]=0
-
-			else:
-				# We need to exclude this server
-				print>>log, "[EPGImport] checkValidServer rejected server download error for: %s" % dirname
-				ServerStatusList[dirname]=0
-		return ServerStatusList[dirname]
-
-	def beginImport(self, longDescUntil = None):
-		'Starts importing using Enigma reactor. Set self.sources before calling this.'
+		'Returns a Deferred that fires with 1 when the server of serverurl is acceptable'
+		return servercheck.getValidator().check(serverurl).addCallback(int)
+
+	def validateSources(self):
+		'Checks the mirrors of all sources that do not have nocheck set, concurrently'
+		urls = set()
+		for source in self.sources:
+			if not source.nocheck:
+				urls.update([url for url in source.urls if isRemote(url)])
+		if not urls:
+			return defer.succeed(None)
+		self.validating = True
+		print>>log, "[EPGImport] Checking %d mirrors" % len(urls)
+		return servercheck.getValidator().checkAll(urls).addBoth(self.applyValidation)
+
+	def applyValidation(self, results):
+		self.validating = False
+		if not isinstance(results, dict):
+			print>>log, "[EPGImport] Server check failed:", results
+			return
+		for source in self.sources:
+			if source.nocheck:
+				continue
+			valid = [url for url in source.urls if results.get(url, True)]
+			if not valid:
+				# Better an outdated mirror than no data at all
+				print>>log, "[EPGImport] All mirrors rejected, trying them anyway:", source.description
+				continue
+			if len(valid) < len(source.urls):
+				print>>log, "[EPGImport] Skipping %d rejected mirrors for %s" % (len(source.urls) - len(valid), source.description)
+				source.urls = valid
+				if source.url not in valid:
+					source.url = mirrors.choose(valid)
+
+	def beginImport(self, longDescUntil = None, window = None):
+		'''Starts importing using Enigma reactor. Set self.sources before calling this.
+		window is (earliest stop, latest start) of the programmes to import.'''
 		if hasattr(self.epgcache, 'importEvents'):
 			self.storage = self.epgcache
 		elif hasattr(self.epgcache, 'importEvent'):
@@ -168,32 +228,229 @@ class EPGImport:
 			print "[EPGImport] oudeis patch not detected, using epg.dat instead."
 			import epgdat_importer
 			self.storage = epgdat_importer.epgdatclass()
+		if getattr(self.storage, 'groupByService', False):
+			# Every service once, whatever order the sources have
+			self.grouping = grouping.EventGrouper()
 		self.eventCount = 0
+		self.storeErrors = 0
+		self.differences = None
 		if longDescUntil is None:
 			# default to 7 days ahead
 			self.longDescUntil = time.time() + 24*3600*7
 		else:
 			self.longDescUntil = longDescUntil;
-		self.nextImport()
+		# Rejected by the parser before their texts are even looked at
+		self.window = window
+		xmltvconverter.setImportWindow(window)
+		self.openDownloadCache()
+		self.validateSources().addCallback(lambda ignore: self.nextImport())
+
+	def openDownloadCache(self):
+		path = staging.getManager().mounted(CACHE_MIN_FREE, *CACHE_LOCATIONS)
+		if path is None:
+			self.downloadCache = None
+			return
+		try:
+			self.downloadCache = downloadcache.DownloadCache(os.path.join(path, 'epgimport.cache'))
+		except Exception, e:
+			print>>log, "[EPGImport] Download cache not available:", e
+			self.downloadCache = None
+		try:
+			self.parseCache = parsecache.ParseCache(os.path.join(path, 'epgimport.parsed'))
+		except Exception, e:
+			print>>log, "[EPGImport] Parse cache not available:", e
+			self.parseCache = None
+		if self.window is not None:
+			earliest = self.window[0]
+		else:
+			earliest = time.time()
+		try:
+			self.channelIndex = channelindex.ChannelIndex(os.path.join(path, 'epgimport.channels'))
+		except Exception, e:
+			print>>log, "[EPGImport] Channel index not available:", e
+			self.channelIndex = None
+		self.snapshot = snapshot.Snapshot(os.path.join(path, 'epgimport.snapshot'), earliest)
 
 	def nextImport(self):
 		self.closeReader()
 		if not self.sources:
-			self.closeImport()
+			if self.grouping is not None:
+				self.storeGroups()
+			else:
+				self.closeImport()
 			return
-		self.source = self.sources.pop()
+		self.source = self.nextSource()
 		print>>log, "[EPGImport] nextImport, source=", self.source.description
-		self.fetchUrl(self.source.url)
+		self.startChannels()
+		self.startPrefetch()
+		prefetch = self.prefetched.pop(self.source, None)
+		if prefetch is None:
+			self.fetchUrl(self.source.url)
+		else:
+			print>>log, "[EPGImport] Using prefetched download:", self.source.url
+			prefetch.attach(self.afterDownload, self.downloadFail)
+
+	def nextSource(self):
+		# Whichever prefetched source has finished downloading goes first
+		for source in reversed(self.sources):
+			prefetch = self.prefetched.get(source)
+			if (prefetch is not None) and prefetch.ready():
+				self.sources.remove(source)
+				return source
+		return self.sources.pop()
+
+	def startPrefetch(self):
+		'Keep up to prefetchDepth downloads running ahead of the parser'
+		if self.streaming():
+			# Prefetching would stage the files we are trying to avoid
+			return
+		for source in reversed(self.sources):
+			if len(self.prefetched) >= self.prefetchDepth:
+				break
+			if (source in self.prefetched) or not isRemote(source.url):
+				continue
+			print>>log, "[EPGImport] Prefetching source:", source.description
+			prefetch = Prefetch()
+			self.prefetched[source] = prefetch
+			self.downloadSource(source, prefetch.done, prefetch.failed)
+
+	def cancelPrefetch(self):
+		for prefetch in self.prefetched.values():
+			prefetch.cancel()
+		self.prefetched = {}
+
+	def streaming(self):
+		# Disk boxes have the download cache, streaming is for those without
+		return self.streamDownloads and (self.downloadCache is None) and useThreads()
 
 	def fetchUrl(self, filename):
-		if filename.startswith('http:') or filename.startswith('ftp:'):
-			self.do_download(filename, self.afterDownload, self.downloadFail)
+		if isRemote(filename):
+			if self.streaming() and (self.source.parser != 'epg.dat'):
+				self.do_stream(filename)
+			else:
+				self.downloadSource(self.source, self.afterDownload, self.downloadFail)
 		else:
 			self.afterDownload(None, filename, deleteFile=False)
 
-	def createIterator(self, filename):
-		self.source.channels.update(self.channelFilter, filename)
-		return getParser(self.source.parser).iterator(self.fd, self.source.channels.items)
+	def createIterator(self, filename, wait=True):
+		self.source.channels.update(self.channelFilter, filename, self.channelIndex, self.channelFilterKey)
+		raw = self.sourceFile
+		self.sourceFile = None
+		if (raw is not None) and (self.parseCache is None):
+			raw.close()
+			raw = None
+		return self.cachedBatches(raw, wait)
+
+	def cachedBatches(self, raw, wait):
+		'''The batches of the source, replayed from or recorded into the parse
+		cache when there is the raw source file. That is hashed a block at a
+		time with None yielded in between, so that the reactor keeps running.'''
+		key = None
+		if raw is not None:
+			try:
+				try:
+					digest = sha1()
+					for step in parsecache.hashSteps(raw, digest):
+						yield None
+					key = self.parseCache.key(digest.hexdigest(), self.source.channels.items, self.source.parser)
+				except Exception, e:
+					print>>log, "[EPGImport] Cannot hash source file:", e
+			finally:
+				raw.close()
+		if key is not None:
+			cached = self.parseCache.replay(key, self.window)
+			if cached is not None:
+				for batch in cached:
+					yield batch
+				return
+		parser = getParser(self.source.parser)
+		if key is None:
+			for batch in self.createParser(parser, wait):
+				yield batch
+			return
+		# Parsed for whole days, the converter takes the window when it starts
+		parsed = parsecache.dayWindow(self.window)
+		xmltvconverter.setImportWindow(parsed)
+		try:
+			batches = self.createParser(parser, wait)
+			for batch in self.parseCache.record(key, parsed, self.window, batches, lambda: getattr(parser, 'failed', False)):
+				yield batch
+		finally:
+			xmltvconverter.setImportWindow(self.window)
+
+	def createParser(self, parser, wait):
+		if (self.parseWorkers > 1) and (PARSERS.get(self.source.parser, self.source.parser) in SHARDED_PARSERS):
+			return sharding.shardedBatches(self.fd, parser, self.source.channels.items, self.parseWorkers, wait)
+		if hasattr(parser, 'batches'):
+			return parser.batches(self.fd, self.source.channels.items)
+		# Parsers that only know the one event at a time interface
+		return xmltvconverter.batchEvents(parser.iterator(self.fd, self.source.channels.items))
+
+	def importBatch(self, services, events):
+		'Hands a list of events for services to the storage'
+		self.eventCount += len(events)
+		until = self.longDescUntil
+		# Remove long descriptions of later events (save RAM memory)
+		if isinstance(events, EventBuffer):
+			events.clearDescriptions(until)
+		else:
+			events = [(d[0] > until) and (d[:4] + ('',) + d[5:]) or d for d in events]
+		if self.grouping is not None:
+			self.grouping.add(services, events)
+			return
+		try:
+			if isinstance(events, EventBuffer):
+				# enigma wants a real list of tuples
+				self.storage.importEvents(services, events.tuples())
+			else:
+				self.storage.importEvents(services, events)
+		except Exception:
+			self.storeErrors += 1
+			raise
+		if self.snapshot is not None:
+			self.snapshot.add(services, events)
+			self.snapshot.written(services)
+
+	def storeGroups(self):
+		'Hands the grouped events to the storage, then finishes the import'
+		if useThreads():
+			d = threads.deferToThread(self.importGroups)
+		else:
+			# One service at a time, the reactor (and so the GUI) runs in between
+			d = task.coiterate(self.writeGroups())
+		d.addErrback(self.storeFailed)
+		d.addBoth(lambda result: self.closeImport())
+
+	def storeFailed(self, failure):
+		self.storeErrors += 1
+		print>>log, "[EPGImport] Storing failed:", failure
+
+	def importGroups(self):
+		for ignore in self.writeGroups():
+			pass
+
+	def writeGroups(self):
+		'Stores the groups, yields after every services'
+		print>>log, "[EPGImport] Storing %d events of %d services" % (self.grouping.count, len(self.grouping.services))
+		# Storage that keeps its data only needs what changed since the last import
+		deltas = (self.snapshot is not None) and getattr(self.storage, 'acceptsDelta', False)
+		for services, events in self.grouping.groups():
+			try:
+				if self.snapshot is not None:
+					self.snapshot.add(services, events)
+				if deltas:
+					self.storage.importEvents(services, events, self.snapshot.delta(services))
+				else:
+					self.storage.importEvents(services, events)
+				if hasattr(self.storage, 'commitService'):
+					# Now, so that a failure shows up with its own services
+					self.storage.commitService()
+				if self.snapshot is not None:
+					self.snapshot.written(services)
+			except Exception, e:
+				self.storeErrors += 1
+				print>>log, "[EPGImport] importEvents exception:", e
+			yield None
 
 	def readEpgDatFile(self, filename, deleteFile=False):
 		if not hasattr(self.epgcache, 'load'):
@@ -226,41 +483,28 @@ class EPGImport:
 			if not os.path.getsize(filename):
 				raise Exception, "File is empty"
 		except Exception, e:
-			self.downloadFail(e)
+			self.downloadFail(Failure(e))
 			return
 		if self.source.parser == 'epg.dat':
-			if twisted.python.runtime.platform.supportsThreads() and os.path.exists("/var/lib/opkg/status"):
+			if useThreads():
 				print>>log, "[EPGImport] Using twisted thread for DAT file"
 				threads.deferToThread(self.readEpgDatFile, filename, deleteFile).addCallback(lambda ignore: self.nextImport())
 			else:
 				self.readEpgDatFile(filename, deleteFile)
 				return
-		if filename.endswith('.gz'):
-			self.fd = gzip.open(filename, 'rb')
-			try:
-				# read a bit to make sure it's a gzip file
-				self.fd.read(10)
-				self.fd.seek(0,0)
-			except Exception, e:
-				print>>log, "[EPGImport] File downloaded is not a valid gzip file", filename
-				self.downloadFail(e)
-				return
-		elif filename.endswith('.xz') or filename.endswith('.lzma'):
-			try:
-				import lzma
-			except ImportError:
-				from backports import lzma
-			self.fd = lzma.open(filename, 'rb')
+		try:
+			# Decompressed by a separate process where possible
+			self.fd = compression.openFile(filename)
+		except Exception, e:
+			print>>log, "[EPGImport] File downloaded is not a valid compressed file", filename
+			self.downloadFail(Failure(e))
+			return
+		if self.parseCache is not None:
 			try:
-				# read a bit to make sure it's an xz file
-				self.fd.read(10)
-				self.fd.seek(0,0)
+				# Hashed by the iterator, the file may be gone by then
+				self.sourceFile = open(filename, 'rb')
 			except Exception, e:
-				print>>log, "[EPGImport] File downloaded is not a valid xz file", filename
-				self.downloadFail(e)
-				return
-		else:
-			self.fd = open(filename, 'rb')
+				print>>log, "[EPGImport] Cannot open %s for the parse cache:" % filename, e
 		if deleteFile and self.source.parser != 'epg.dat':
 			try:
 				print>>log, "[EPGImport] unlink", filename
@@ -268,13 +512,40 @@ class EPGImport:
 					os.unlink(filename)
 			except Exception, e:
 				print>>log, "[EPGImport] warning: Could not remove '%s' intermediate" % filename, e
-		self.channelFiles = self.source.channels.downloadables()
+		self.waitForChannels()
+
+	def startChannels(self):
+		'The channel file is downloaded alongside the programme file'
+		self.cancelChannels()
+		self.channelFetch = Prefetch()
+		if self.source.parser == 'epg.dat':
+			self.channelFiles = []
+		else:
+			# A copy, the failover below must not shrink the channel's url list
+			self.channelFiles = list(self.source.channels.downloadables() or [])
 		if not self.channelFiles:
-			self.afterChannelDownload(None, None)
+			self.channelFetch.done(None, None, False)
 		else:
-			filename = random.choice(self.channelFiles)
-			self.channelFiles.remove(filename)
-			self.do_download(filename, self.afterChannelDownload, self.channelDownloadFail)
+			self.downloadChannels()
+
+	def downloadChannels(self):
+		fetch = self.channelFetch
+		filename = mirrors.choose(self.channelFiles)
+		self.channelFiles.remove(filename)
+		self.do_download(filename, fetch.done, lambda failure: self.channelDownloadFail(failure, fetch), self.source.channels.urls)
+
+	def cancelChannels(self):
+		if self.channelFetch is not None:
+			self.channelFetch.cancel()
+			self.channelFetch = None
+
+	def waitForChannels(self):
+		'Parsing starts once the channel file is there as well'
+		self.channelFetch.attach(self.afterChannelDownload, self.channelsFailed)
+
+	def channelsFailed(self, failure):
+		print>>log, "[EPGImport] no more alternatives for channels"
+		self.nextImport()
 
 	def afterChannelDownload(self, result, filename, deleteFile=True):
 		print>>log, "[EPGImport] afterChannelDownload", filename
@@ -283,15 +554,21 @@ class EPGImport:
 				if not os.path.getsize(filename):
 					raise Exception, "File is empty"
 			except Exception, e:
-				self.channelDownloadFail(e)
+				# The programme file is waiting, try the next channel file
+				self.channelFetch = Prefetch()
+				self.waitForChannels()
+				self.channelDownloadFail(Failure(e), self.channelFetch)
 				return
-		if twisted.python.runtime.platform.supportsThreads() and os.path.exists("/var/lib/opkg/status"):
+		if useThreads():
 			print>>log, "[EPGImport] Using twisted thread"
-			threads.deferToThread(self.doThreadRead, filename).addCallback(lambda ignore: self.nextImport())
+			threads.deferToThread(self.doThreadRead, filename, deleteFile).addCallback(self.afterThreadRead)
 			deleteFile = False # Thread will delete it
 		else:
-			self.iterator = self.createIterator(filename)
-			reactor.addReader(self)
+			# Never block the reactor waiting for parser processes. Not
+			# driven by polling self.fd: the pipe of an external decompressor
+			# hangs up while the parser still holds batches.
+			self.iterator = self.createIterator(filename, wait=False)
+			task.coiterate(self.readBatches(self.iterator)).addCallback(self.afterRead, self.iterator)
 		if deleteFile and filename:
 			try:
 				if not filename.endswith("epg.db"):
@@ -299,88 +576,125 @@ class EPGImport:
 			except Exception, e:
 				print>>log, "[EPGImport] warning: Could not remove '%s' intermediate" % filename, e
 
-	def fileno(self):
-		if self.fd is not None:
-			return self.fd.fileno()
+	def afterThreadRead(self, result):
+		pipe = self.stream
+		if (pipe is not None) and (pipe.failure is not None) and not pipe.received:
+			# Nothing arrived at all, so another mirror can still be tried
+			self.closeReader()
+			# The channel file was used up by this attempt
+			self.startChannels()
+			self.downloadFail(pipe.failure)
+		else:
+			self.nextImport()
 
-	def doThreadRead(self, filename):
+	def doThreadRead(self, filename, deleteFile=True):
 		'This is used on PLi with threading'
-		for data in self.createIterator(filename):
-			if data is not None:
-				self.eventCount += 1
-				try:
-					r,d = data
-					if d[0] > self.longDescUntil:
-						# Remove long description (save RAM memory)
-						d = d[:4] + ('',) + d[5:]
-					self.storage.importEvents(r, (d,))
-				except Exception, e:
-					print>>log, "[EPGImport] ### importEvents exception:", e
+		try:
+			for batch in self.createIterator(filename):
+				if batch is not None:
+					try:
+						self.importBatch(*batch)
+					except Exception, e:
+						print>>log, "[EPGImport] ### importEvents exception:", e
+		except Exception, e:
+			# Keep what came through, the import goes on with the next source
+			print>>log, "[EPGImport] Parsing failed:", e
 		print>>log, "[EPGImport] ### thread is ready ### Events:", self.eventCount
-		if filename:
+		if filename and deleteFile:
 			try:
 				if not filename.endswith("epg.db"):
 					os.unlink(filename)
 			except Exception, e:
 				print>>log, "[EPGImport] warning: Could not remove '%s' intermediate" % filename, e
 
-	def doRead(self):
-		'called from reactor to read some data'
+	def readBatches(self, iterator):
+		'Imports the batches of iterator, run by task.coiterate so that the reactor runs in between'
 		try:
-			# returns tuple (ref, data) or None when nothing available yet.
-			data = self.iterator.next()
-			if data is not None:
-				self.eventCount += 1
-				try:
-					r,d = data
-					if d[0] > self.longDescUntil:
-						# Remove long description (save RAM memory)
-						d = d[:4] + ('',) + d[5:]
-					self.storage.importEvents(r, (d,))
-				except Exception, e:
-					print>>log, "[EPGImport] importEvents exception:", e
-		except StopIteration:
-			self.nextImport()
+			# None when nothing is available yet
+			for batch in iterator:
+				if self.iterator is not iterator:
+					# closeReader gave up on this source
+					return
+				if batch is not None:
+					try:
+						self.importBatch(*batch)
+					except Exception, e:
+						print>>log, "[EPGImport] importEvents exception:", e
+				yield None
+		except Exception, e:
+			# Keep what came through, the import goes on with the next source
+			print>>log, "[EPGImport] Parsing failed:", e
 
-	def connectionLost(self, failure):
-		'called from reactor on lost connection'
-		# This happens because enigma calls us after removeReader
-		print>>log, "[EPGImport] connectionLost", failure
+	def afterRead(self, result, iterator):
+		if self.iterator is iterator:
+			self.nextImport()
 
-	def channelDownloadFail(self, failure):
+	def channelDownloadFail(self, failure, fetch):
+		if fetch is not self.channelFetch:
+			# Left over from a source that was given up on
+			return
 		print>>log, "[EPGImport] download channel failed:", failure
 		if self.channelFiles:
-			filename = random.choice(self.channelFiles)
-			self.channelFiles.remove(filename)
-			self.do_download(filename, self.afterChannelDownload, self.channelDownloadFail)
+			self.downloadChannels()
 		else:
-			print>>log, "[EPGImport] no more alternatives for channels"
-			self.nextImport()
+			for url in self.source.channels.urls:
+				self.dropPartials(url)
+			fetch.failed(failure)
 
 	def downloadFail(self, failure):
 		print>>log, "[EPGImport] download failed:", failure
+		if not isinstance(failure, Failure):
+			failure = Failure(failure)
+		if self.retryPartial(self.source.url):
+			print>>log, "[EPGImport] Resuming from the same mirror"
+			self.fetchUrl(self.source.url)
+			return
+		if failure.check(httpdownload.ResumeMismatch):
+			print>>log, "[EPGImport] Mirror has a different file, downloading it in full"
+			self.fetchUrl(self.source.url)
+			return
 		self.source.urls.remove(self.source.url)
 		if self.source.urls:
 			print>>log, "[EPGImport] Attempting alternative URL"
-			self.source.url = random.choice(self.source.urls)
+			self.source.url = mirrors.choose(self.source.urls)
 			self.fetchUrl(self.source.url)
 		else:
+			self.dropPartials(self.source.url)
 			self.nextImport()
 
-	def logPrefix(self):
-		return '[EPGImport]'
-
 	def closeReader(self):
 		if self.fd is not None:
-			reactor.removeReader(self)
 			self.fd.close()
 			self.fd = None
 			self.iterator = None
+		if self.sourceFile is not None:
+			self.sourceFile.close()
+			self.sourceFile = None
+		self.stream = None
 
 	def closeImport(self):
 		self.closeReader()
+		self.cancelPrefetch()
+		self.cancelChannels()
+		self.dropPartials()
+		if self.grouping is not None:
+			self.grouping.close()
+			self.grouping = None
 		self.iterator = None
 		self.source = None
+		self.downloadCache = None
+		self.parseCache = None
+		self.channelIndex = None
+		if hasattr(self.storage, 'epg_done') and not self.storage.epg_done():
+			self.storeErrors += 1
+		if self.snapshot is not None:
+			if self.storeErrors:
+				# The storage may lack what the fingerprints say
+				print>>log, "[EPGImport] Storing failed, keeping the previous import snapshot"
+			elif self.eventCount:
+				self.logDifferences()
+				self.snapshot.save()
+			self.snapshot = None
 		if hasattr(self.storage, 'epgfile'):
 			needLoad = self.storage.epgfile
 		else:
@@ -412,50 +726,217 @@ class EPGImport:
 		self.eventCount = None
 		print>>log, "[EPGImport] #### Finished ####"
 
+	def logDifferences(self):
+		summary = self.snapshot.summary()
+		self.differences = summary
+		if summary is None:
+			print>>log, "[EPGImport] No previous import to compare with"
+			return
+		print>>log, "[EPGImport] Since the previous import: %d new, %d changed, %d removed, %d unchanged events" % summary
+
 	def isImportRunning(self):
-		return self.source is not None
+		return self.validating or (self.source is not None)
 
-	def legacyDownload(self, result, afterDownload, downloadFail, sourcefile, filename, deleteFile=True):
-		print>>log, "[EPGImport] IPv6 download failed, falling back to IPv4: " + sourcefile
-		downloadPage(sourcefile, filename).addCallbacks(afterDownload, downloadFail, callbackArgs=(filename,True))
+	def startTransfer(self, sourcefile, fileOrName, headers, watcher=None, **kwargs):
+		'Returns a Deferred that fires with the factory of the completed transfer'
+		# IPv6 and IPv4 are tried side by side, see eyeballs.py
+		return httpdownload.download(sourcefile, fileOrName, headers=headers, watcher=watcher, **kwargs)
 
-	def do_download(self, sourcefile, afterDownload, downloadFail):
-		path = bigStorage(9000000, '/tmp', '/media/DOMExtender', '/media/cf', '/media/mmc', '/media/usb', '/media/hdd')
-		filename = os.path.join(path, 'epgimport')
+	def recordTransfer(self, factory, sourcefile, measured=True):
+		if measured:
+			size = factory.received
+		else:
+			size = 0
+		mirrors.getScoreboard().success(sourcefile, size, factory.timeToFirstByte(), factory.duration())
+
+	def recordFailure(self, failure, sourcefile):
+		if not isinstance(failure, Failure):
+			failure = Failure(failure)
+		if failure.check(httpdownload.ResumeMismatch):
+			# Nothing wrong with the mirror
+			return failure
+		if not (failure.check(WebError) and (failure.value.status == '304')):
+			mirrors.getScoreboard().failure(sourcefile)
+		return failure
+
+	def downloadComplete(self, factory, sourcefile, filename=None):
+		if filename is None:
+			filename = factory.fileName
+		# On disk now, statvfs accounts for it
+		staging.getManager().release(filename)
+		self.recordTransfer(factory, sourcefile)
+		if self.downloadCache is not None:
+			cached = self.downloadCache.store(sourcefile, filename,
+				httpdownload.getHeader(factory, 'etag'), httpdownload.getHeader(factory, 'last-modified'))
+			if cached is not None:
+				return (cached, False)
+		return (filename, True)
+
+	def downloadError(self, failure, sourcefile, filename, transfer=(), alternatives=(), previous=None):
+		if (filename is None) and transfer:
+			filename = transfer[0].fileName
+		if filename:
+			staging.getManager().release(filename)
+		self.recordFailure(failure, sourcefile)
+		if transfer and not failure.check(WebError):
+			factory = transfer[0]
+			if not (factory.aborted or factory.mismatch):
+				partial = httpdownload.PartialDownload(sourcefile, filename, factory, alternatives, previous)
+				if partial.usable():
+					print>>log, "[EPGImport] Keeping %d of %d bytes to resume %s" % (partial.size(), partial.length, sourcefile)
+					self.partials.append(partial)
+					return failure
+		if filename:
+			unlink_if_exists(filename)
+		if failure.check(WebError) and (failure.value.status == '304') and (self.downloadCache is not None):
+			cached = self.downloadCache.lookup(sourcefile)
+			if cached is not None:
+				print>>log, "[EPGImport] Not modified, using cached copy of " + sourcefile
+				return (cached, False)
+		return failure
+
+	def deliverDownload(self, result, afterDownload):
+		filename, deleteFile = result
+		afterDownload(None, filename, deleteFile)
+
+	def downloadFilename(self, sourcefile, size=None):
+		'Creates the file a download of size bytes (None if unknown) goes to'
+		manager = staging.getManager()
+		if self.downloadCache is not None:
+			path = self.downloadCache.path
+		else:
+			path = manager.locate(size)
 		ext = os.path.splitext(sourcefile)[1]
 		# Keep sensible extension, in particular the compression type
-		if ext and len(ext) < 6:
-			filename += ext
-		sourcefile = sourcefile.encode('utf-8')
-		print>>log, "[EPGImport] Downloading: " + sourcefile + " to local path: " + filename
+		if not ext or len(ext) >= 6:
+			ext = ''
+		# Every transfer gets its own file, several may be running at once
+		fd, filename = tempfile.mkstemp(suffix=ext, prefix='epgimport.', dir=path)
+		os.close(fd)
+		manager.reserve(filename, size)
+		return filename
 
-		ip6 = sourcefile6 = None
-		if has_ipv6 and version_info >= (2,7,11) and ((version.major == 15 and version.minor >= 5) or version.major >= 16):
-			host = sourcefile.split("/")[2]
-			# getaddrinfo throws exception on literal IPv4 addresses
-			try:
-				ip6 = getaddrinfo(host,0, AF_INET6)
-				sourcefile6 = sourcefile.replace(host,"[" + list(ip6)[0][4][0] + "]")
-			except:
-				pass
-
-		#if self.source.nocheck == 1:
-		#	print>>log, "[EPGImport] Not cheching the server since nocheck is set for it: " + sourcefile
-		if ip6:
-			print>>log, "[EPGImport] Trying IPv6 first: " + sourcefile6
-			downloadPage(sourcefile6, filename, headers={'host': host}).addCallback(afterDownload, filename, True).addErrback(self.legacyDownload, afterDownload, downloadFail, sourcefile, filename, True)
-		else:
-			print>>log, "[EPGImport] No IPv6, using IPv4 directly: " + sourcefile
-			downloadPage(sourcefile, filename).addCallbacks(afterDownload, downloadFail, callbackArgs=(filename,True))
+	def placeDownload(self, sourcefile, factory):
+		'The response headers are in, put the file where it fits'
+		size = httpdownload.totalLength(factory)
+		filename = self.downloadFilename(sourcefile, size)
+		print>>log, "[EPGImport] Saving %s bytes to local path: %s" % (size or 'unknown', filename)
 		return filename
 
-		#if self.checkValidServer(sourcefile) == 1:
-		#	if ip6:
-		#		print>>log, "[EPGImport] Trying IPv6 first: " + sourcefile6
-		#		downloadPage(sourcefile6, filename, headers={'host': host}).addCallback(afterDownload, filename, True).addErrback(self.legacyDownload, afterDownload, downloadFail, sourcefile, filename, True)
-		#	else:
-		#		print>>log, "[EPGImport] No IPv6, using IPv4 directly: " + sourcefile
-		#		downloadPage(sourcefile, filename).addCallbacks(afterDownload, downloadFail, callbackArgs=(filename,True))
-		#	return filename
-		#else:
-		#	self.downloadFail("checkValidServer reject the server")
+	def downloadHeaders(self, sourcefile):
+		headers = {}
+		if self.downloadCache is not None:
+			headers.update(self.downloadCache.validators(sourcefile))
+		return headers
+
+	def downloadSource(self, source, afterDownload, downloadFail):
+		'Downloads the programme file of source, racing mirrors when enabled'
+		if self.raceMirrors > 1:
+			others = [url for url in mirrors.getScoreboard().rank(source.urls) if (url != source.url) and isRemote(url)]
+			urls = [source.url] + others[:self.raceMirrors - 1]
+			if len(urls) > 1:
+				self.do_race(source, urls, afterDownload, downloadFail)
+				return
+		self.do_download(source.url, afterDownload, downloadFail, source.urls)
+
+	def takePartial(self, sourcefile):
+		for partial in self.partials:
+			if partial.matches(sourcefile):
+				self.partials.remove(partial)
+				return partial
+		return None
+
+	def dropPartials(self, sourcefile=None):
+		for partial in self.partials[:]:
+			if (sourcefile is None) or partial.matches(sourcefile):
+				self.partials.remove(partial)
+				partial.discard()
+
+	def retryPartial(self, sourcefile):
+		'True when a broken download of sourcefile should be resumed from the same mirror'
+		for partial in self.partials:
+			if partial.url == sourcefile:
+				if partial.attempts < RESUME_ATTEMPTS:
+					partial.attempts += 1
+					return True
+		return False
+
+	def do_download(self, sourcefile, afterDownload, downloadFail, alternatives=()):
+		sourcefile = sourcefile.encode('utf-8')
+		headers = self.downloadHeaders(sourcefile)
+		partial = self.takePartial(sourcefile)
+		if partial is not None:
+			filename = partial.filename
+			headers.update(partial.headers())
+			# Downloader asks for the rest with a Range header
+			kwargs = {'supportPartial': 1, 'expectedLength': partial.length}
+			print>>log, "[EPGImport] Resuming download at %d bytes: %s" % (partial.size(), sourcefile)
+		else:
+			# Named once Content-Length tells how much room it needs
+			filename = None
+			kwargs = {'placeFile': lambda factory: self.placeDownload(sourcefile, factory)}
+			print>>log, "[EPGImport] Downloading: " + sourcefile
+		transfer = []
+		d = self.startTransfer(sourcefile, filename, headers, watcher=transfer.append, **kwargs)
+		d.addCallbacks(self.downloadComplete, self.downloadError, callbackArgs=(sourcefile, filename), errbackArgs=(sourcefile, filename, transfer, alternatives, partial))
+		d.addCallbacks(self.deliverDownload, downloadFail, callbackArgs=(afterDownload,))
+
+	def do_race(self, source, urls, afterDownload, downloadFail):
+		race = mirrorrace.MirrorRace()
+		for url in urls:
+			filename = self.downloadFilename(url)
+			url = url.encode('utf-8')
+			print>>log, "[EPGImport] Racing: " + url + " to local path: " + filename
+			racer = race.add(url, filename)
+			race.follow(racer, self.startTransfer(url, filename, self.downloadHeaders(url), racer.watch))
+		race.start()
+		race.deferred.addCallbacks(self.raceComplete, self.raceFailed, callbackArgs=(race, source, urls), errbackArgs=(race, source, urls))
+		race.deferred.addCallbacks(self.deliverDownload, downloadFail, callbackArgs=(afterDownload,))
+
+	def releaseRace(self, race):
+		for racer in race.racers:
+			staging.getManager().release(racer.filename)
+
+	def raceComplete(self, factory, race, source, urls):
+		self.releaseRace(race)
+		for url, failure in race.failures:
+			self.recordFailure(failure, url)
+		source.url = urls[race.racers.index(race.winner)]
+		return self.downloadComplete(factory, race.winner.url, race.winner.filename)
+
+	def raceFailed(self, failure, race, source, urls):
+		self.releaseRace(race)
+		for url, f in race.failures:
+			self.recordFailure(f, url)
+		if race.winner is not None:
+			source.url = urls[race.racers.index(race.winner)]
+			return self.downloadError(failure, race.winner.url, race.winner.filename)
+		# Every raced mirror failed, downloadFail drops the last one and moves on
+		for url in urls[:-1]:
+			source.urls.remove(url)
+		source.url = urls[-1]
+		return failure
+
+	def do_stream(self, sourcefile):
+		'Parses the source while it is being received, without a staging file'
+		sourcefile = sourcefile.encode('utf-8')
+		print>>log, "[EPGImport] Streaming: " + sourcefile
+		pipe = stream.StreamPipe()
+		writer = stream.PipeWriter(pipe)
+		d = self.startTransfer(sourcefile, writer, {})
+		d.addCallbacks(self.streamComplete, self.streamFailed, callbackArgs=(sourcefile, pipe), errbackArgs=(sourcefile, pipe))
+		self.stream = pipe
+		self.fd = compression.openStream(pipe, sourcefile)
+		# The channel file download was started already
+		self.waitForChannels()
+
+	def streamComplete(self, factory, sourcefile, pipe):
+		print>>log, "[EPGImport] Stream complete, %d bytes" % pipe.received
+		# The parser set the pace, this is no throughput measurement
+		self.recordTransfer(factory, sourcefile, measured=False)
+		pipe.finish()
+
+	def streamFailed(self, failure, sourcefile, pipe):
+		print>>log, "[EPGImport] Stream failed:", failure.getErrorMessage()
+		self.recordFailure(failure, sourcefile)
+		pipe.fail(failure)
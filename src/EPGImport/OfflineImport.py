@@ -3,8 +3,7 @@
 # To test this script on something that is not a Dreambox, such as a Windows PC
 # just run it with Python. You'll need Python's "twisted" library.
 # Supply the test .xml files on the command line, and the input files
-# where they can be found. On Linux, you can also download from the internet,
-# on windows the xmltv files must be local files.
+# where they can be found, local files or on the internet.
 #
 import os
 import sys
@@ -24,25 +23,6 @@ class FakeEnigma:
 #		print args
 
 def importFrom(epgimport, sourceXml):
-	# Hack to make this test run on Windows (where the reactor cannot handle files)
-	if sys.platform.startswith('win'):
-		import twisted.python.runtime
-		twisted.python.runtime.platform.supportsThreads = lambda: False
-		class FakeReactor:
-			def addReader(self, r):
-				self.r = r
-			def removeReader(self, r):
-				if self.r is r:
-					self.r = None
-				else:
-					raise Exception, "Removed reader without adding it"
-			def run(self):
-				while self.r is not None:
-					self.r.doRead()
-			def stop(self):
-				print "reactor stopped"
-				pass
-		EPGImport.reactor = FakeReactor()
 	sources = [ s for s in EPGConfig.enumSourcesFile(sourceXml, filter = None) ]
 	sources.reverse()
 	epgimport.sources = sources
@@ -57,8 +37,15 @@ def done(reboot=False, epgfile=None):
 	### When code arrives here, EPG data is stored in filename EPGImport.HDD_EPG_DAT
 	### So to copy it to FTP or whatever, this is the place to add that code.
 
-if len(sys.argv) <= 1:
-	print "Usage: %s source.xml [...]" % sys.argv[0]
+args = sys.argv[1:]
+workers = 1
+if args and args[0].startswith('-j'):
+	# -jN or -j N parses big files in N processes
+	option = args.pop(0)[2:] or args.pop(0)
+	workers = int(option)
+if not args:
+	print "Usage: %s [-j processes] source.xml [...]" % sys.argv[0]
 epgimport = EPGImport.EPGImport(FakeEnigma(), lambda x: True)
-for xml in sys.argv[1:]:
+epgimport.parseWorkers = workers
+for xml in args:
 	importFrom(epgimport, xml)
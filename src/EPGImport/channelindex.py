@@ -0,0 +1,104 @@
+#
+# On-disk index of filtered channel maps.
+#
+# Reading a channels.xml means parsing the XML and asking the channel
+# filter about every service reference in it. The resulting id -> refs
+# map only changes when the file or the filter settings change, so it is
+# kept under a key of both and read back in one go.
+#
+import os
+import cPickle as pickle
+from hashlib import sha1
+import log
+from parsecache import fileHash
+
+# Bump when the maps are built differently from the same input
+INDEX_VERSION = 1
+# Channel maps kept, the least recently used go first
+MAX_ENTRIES = 32
+SUFFIX = '.channels'
+
+class ChannelIndex:
+	def __init__(self, path):
+		self.path = path
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		self.purge()
+
+	def key(self, filename, filterKey):
+		'Key of the channel map of filename, None when the file cannot be read'
+		try:
+			f = open(filename, 'rb')
+		except IOError:
+			return None
+		try:
+			contentHash = fileHash(f)
+		finally:
+			f.close()
+		digest = sha1()
+		digest.update('%d %s\n' % (INDEX_VERSION, contentHash))
+		digest.update(filterKey)
+		return digest.hexdigest()
+
+	def filename(self, key):
+		return os.path.join(self.path, key + SUFFIX)
+
+	def load(self, key):
+		'The channel map stored under key, None when there is none'
+		filename = self.filename(key)
+		try:
+			f = open(filename, 'rb')
+			try:
+				data = f.read()
+			finally:
+				f.close()
+			items = pickle.loads(data)
+		except Exception:
+			return None
+		try:
+			# Least recently used goes first, see purge
+			os.utime(filename, None)
+		except Exception:
+			pass
+		return items
+
+	def store(self, key, items):
+		filename = self.filename(key)
+		temp = filename + '.tmp'
+		try:
+			f = open(temp, 'wb')
+			try:
+				pickle.dump(items, f, pickle.HIGHEST_PROTOCOL)
+			finally:
+				f.close()
+			os.rename(temp, filename)
+		except Exception, e:
+			print>>log, "[EPGImport] Cannot store channel map:", e
+			try:
+				os.unlink(temp)
+			except Exception:
+				pass
+			return
+		self.purge()
+
+	def purge(self):
+		entries = []
+		for fn in os.listdir(self.path):
+			name = os.path.join(self.path, fn)
+			if not fn.endswith(SUFFIX):
+				# Leftovers of an interrupted write
+				try:
+					os.unlink(name)
+				except Exception:
+					pass
+				continue
+			try:
+				entries.append((os.path.getmtime(name), name))
+			except Exception:
+				pass
+		entries.sort(reverse=True)
+		for mtime, name in entries[MAX_ENTRIES:]:
+			try:
+				os.unlink(name)
+			except Exception:
+				pass
@@ -0,0 +1,371 @@
+# Decompression of source and channel files.
+#
+# The format is recognised by the first bytes of the data, not by the
+# file name, so a decoder can be picked without rewinding anything.
+# Files on disk are preferably inflated by gzip/xz/bzip2/zstd running
+# as a separate process, so that inflating and XML parsing run on
+# different cores instead of taking turns under the GIL. When the tool
+# is missing or fails to start, the in-process modules are used.
+#
+import os
+import zlib
+import subprocess
+import log
+
+# Set to False to always decompress in-process
+USE_EXTERNAL = True
+# Command lines of the external decompressors, they write to stdout
+EXTERNAL_HELPERS = {
+	'gzip': ('gzip', '-dc'),
+	'xz': ('xz', '-dc'),
+	'bzip2': ('bzip2', '-dc'),
+	'zstd': ('zstd', '-dc'),
+}
+MAGIC = (
+	('\x1f\x8b', 'gzip'),
+	('\xfd7zXZ\x00', 'xz'),
+	# legacy .lzma files, properties byte and dictionary size
+	('\x5d\x00\x00', 'xz'),
+	('BZh', 'bzip2'),
+	('\x28\xb5\x2f\xfd', 'zstd'),
+)
+SNIFF_SIZE = 6
+COMPRESSED_EXTENSIONS = ('.gz', '.xz', '.lzma', '.bz2', '.zst')
+
+def lzmaModule():
+	try:
+		import lzma
+	except ImportError:
+		from backports import lzma
+	return lzma
+
+def zstdModule():
+	import zstandard
+	return zstandard
+
+def detect(head, filename=''):
+	'Returns the compression of data starting with head, None for plain files'
+	for magic, kind in MAGIC:
+		if head.startswith(magic):
+			return kind
+	if filename.endswith(COMPRESSED_EXTENSIONS) and not head.lstrip('\xef\xbb\xbf \t\r\n').startswith('<'):
+		# Named like a compressed file, but neither that nor XML
+		raise IOError, "%s is not a known compressed format" % filename
+	# Some servers inflate .gz files on the fly, so XML is fine too
+	return None
+
+def decompressorFactory(kind):
+	'Returns a callable creating incremental decompressors for kind'
+	if kind == 'gzip':
+		# 16 + MAX_WBITS: expect a gzip header
+		return lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+	elif kind == 'xz':
+		return lzmaModule().LZMADecompressor
+	elif kind == 'bzip2':
+		import bz2
+		return bz2.BZ2Decompressor
+	elif kind == 'zstd':
+		try:
+			return zstdModule().ZstdDecompressor().decompressobj
+		except ImportError:
+			raise IOError, "No zstd support, install python-zstandard or zstd"
+	raise IOError, "Unknown compression %s" % kind
+
+def readHead(fd, size):
+	'Reads size bytes, short only at the end of the data'
+	head = ''
+	while len(head) < size:
+		data = fd.read(size - len(head))
+		if not data:
+			break
+		head += data
+	return head
+
+class PrefixReader:
+	'Returns head, then the rest of fd'
+	def __init__(self, head, fd):
+		self.head = head
+		self.fd = fd
+
+	def read(self, size=-1):
+		if not self.head:
+			return self.fd.read(size)
+		if size < 0:
+			data = self.head + self.fd.read()
+			self.head = ''
+			return data
+		if size >= len(self.head):
+			data = self.head
+			self.head = ''
+		else:
+			data = self.head[:size]
+			self.head = self.head[size:]
+		return data
+
+	def fileno(self):
+		return self.fd.fileno()
+
+	def close(self):
+		self.fd.close()
+
+class DecompressingReader:
+	'File-like object that inflates what it reads from another file object'
+	def __init__(self, fd, decompressor, blocksize=65536, factory=None, head=''):
+		self.fd = fd
+		self.decompressor = decompressor
+		# Creates the decompressor for a following member or frame
+		self.factory = factory
+		self.blocksize = blocksize
+		self.pending = ''
+		self.eof = False
+		if head:
+			self.pending = self.decompress(head)
+
+	def feed(self, data):
+		try:
+			return self.decompressor.decompress(data)
+		except EOFError:
+			# bz2 and xz refuse data once their member has ended, which
+			# happens when a member ended exactly at the end of a block
+			if self.factory is None:
+				raise
+			if not data.strip('\x00'):
+				# padding at the end
+				return ''
+			self.decompressor = self.factory()
+			return self.decompressor.decompress(data)
+
+	def decompress(self, data):
+		result = self.feed(data)
+		leftover = getattr(self.decompressor, 'unused_data', '')
+		while leftover and (self.factory is not None):
+			if not leftover.strip('\x00'):
+				# padding at the end, like gzip tolerates
+				break
+			# concatenated members, e.g. from pigz or pbzip2
+			self.decompressor = self.factory()
+			result += self.decompressor.decompress(leftover)
+			leftover = getattr(self.decompressor, 'unused_data', '')
+		return result
+
+	def read(self, size=-1):
+		while (not self.pending or (size < 0)) and not self.eof:
+			data = self.fd.read(self.blocksize)
+			if data:
+				self.pending += self.decompress(data)
+			else:
+				self.eof = True
+				flush = getattr(self.decompressor, 'flush', None)
+				if flush is not None:
+					self.pending += flush()
+		if (size < 0) or (size >= len(self.pending)):
+			data = self.pending
+			self.pending = ''
+		else:
+			data = self.pending[:size]
+			self.pending = self.pending[size:]
+		return data
+
+	def fileno(self):
+		return self.fd.fileno()
+
+	def close(self):
+		self.fd.close()
+
+def decompressingReader(fd, kind, head=''):
+	factory = decompressorFactory(kind)
+	return DecompressingReader(fd, factory(), factory=factory, head=head)
+
+class SniffingReader:
+	'Picks the decoder on the first read, when data is there to look at'
+	def __init__(self, fd, filename=''):
+		self.fd = fd
+		self.filename = filename
+		self.reader = None
+
+	def read(self, size=-1):
+		if self.reader is None:
+			head = readHead(self.fd, SNIFF_SIZE)
+			kind = detect(head, self.filename)
+			if kind is None:
+				self.reader = PrefixReader(head, self.fd)
+			else:
+				self.reader = decompressingReader(self.fd, kind, head)
+		return self.reader.read(size)
+
+	def close(self):
+		self.fd.close()
+
+def openStream(fd, filename=''):
+	'Wraps file object fd so that reading returns the decompressed content'
+	# Nothing may be read here, fd can be a download that is still starting
+	return SniffingReader(fd, filename)
+
+_helpers = {}
+
+def findHelper(kind):
+	'Returns the command line for decompressing kind externally, or None'
+	if kind not in _helpers:
+		args = EXTERNAL_HELPERS.get(kind)
+		_helpers[kind] = None
+		if args is not None:
+			for path in os.environ.get('PATH', '/bin:/usr/bin').split(os.pathsep):
+				tool = os.path.join(path, args[0])
+				if os.access(tool, os.X_OK):
+					_helpers[kind] = (tool,) + tuple(args[1:])
+					break
+	return _helpers[kind]
+
+class ProcessReader:
+	'Reads the output of a decompressor running as a separate process'
+	def __init__(self, args, filename, blocksize=65536):
+		devnull = open(os.devnull, 'wb')
+		stdin = open(filename, 'rb')
+		try:
+			self.proc = subprocess.Popen(args, stdin=stdin, stdout=subprocess.PIPE, stderr=devnull, close_fds=True)
+		finally:
+			# The child has its own copies
+			stdin.close()
+			devnull.close()
+		self.name = args[0]
+		self.fd = self.proc.stdout
+		self.eof = False
+		# Make sure it is happy with the file before handing it out
+		self.pending = os.read(self.fd.fileno(), blocksize)
+		if not self.pending:
+			self.finish()
+
+	def finish(self):
+		self.eof = True
+		try:
+			status = self.proc.wait()
+		except OSError:
+			# Reaped by someone else's SIGCHLD handler, cannot tell
+			status = 0
+		if status:
+			raise IOError, "%s exited with status %s" % (self.name, status)
+
+	def fileno(self):
+		return self.fd.fileno()
+
+	def read(self, size=-1):
+		if size < 0:
+			data = self.pending
+			self.pending = ''
+			if not self.eof:
+				data += self.fd.read()
+				self.finish()
+			return data
+		if self.pending:
+			if size >= len(self.pending):
+				data = self.pending
+				self.pending = ''
+			else:
+				data = self.pending[:size]
+				self.pending = self.pending[size:]
+			return data
+		if self.eof:
+			return ''
+		# Whatever is there, like a socket, does not wait for size bytes
+		data = os.read(self.fd.fileno(), size)
+		if not data:
+			self.finish()
+		return data
+
+	def close(self):
+		if self.proc.poll() is None:
+			try:
+				self.proc.kill()
+				self.proc.wait()
+			except OSError:
+				pass
+		self.fd.close()
+
+def openFile(filename, external=None):
+	'Opens filename, reading returns its decompressed content'
+	fd = open(filename, 'rb')
+	try:
+		head = readHead(fd, SNIFF_SIZE)
+		kind = detect(head, filename)
+	except:
+		fd.close()
+		raise
+	if kind is None:
+		return PrefixReader(head, fd)
+	if external is None:
+		external = USE_EXTERNAL
+	if external:
+		args = findHelper(kind)
+		if args is not None:
+			try:
+				reader = ProcessReader(args, filename)
+				fd.close()
+				return reader
+			except Exception, e:
+				print>>log, "[EPGImport] %s failed, decompressing in-process:" % args[0], e
+	try:
+		reader = decompressingReader(fd, kind, head)
+		# Decode the first block, so that garbage is noticed up front
+		data = reader.read(reader.blocksize)
+		reader.pending = data + reader.pending
+	except:
+		fd.close()
+		raise
+	return reader
+
+if __name__ == '__main__':
+	# Benchmark: decompress and parse each format in-process and with the
+	# external helper. Usage: python compression.py [file.xml]
+	import sys
+	import time
+	import shutil
+	import tempfile
+	from xml.etree.cElementTree import iterparse
+	workdir = tempfile.mkdtemp()
+	try:
+		if len(sys.argv) > 1:
+			source = sys.argv[1]
+		else:
+			source = os.path.join(workdir, 'sample.xml')
+			f = open(source, 'wb')
+			f.write('<?xml version="1.0" encoding="UTF-8"?>\n<tv>\n')
+			for i in xrange(200000):
+				f.write('<programme start="20240101%06d +0000" stop="20240101%06d +0000" channel="channel%d.nl">'
+					'<title lang="nl">Title %d</title><desc lang="nl">Description of programme %d, '
+					'somewhat longer to look like real data.</desc></programme>\n' % (i % 240000, (i + 1) % 240000, i % 50, i, i))
+			f.write('</tv>\n')
+			f.close()
+		print "Source: %s, %d bytes" % (source, os.path.getsize(source))
+		formats = [('.gz', 'gzip'), ('.xz', 'xz'), ('.bz2', 'bzip2'), ('.zst', 'zstd')]
+		for ext, kind in formats:
+			target = os.path.join(workdir, 'sample.xml' + ext)
+			try:
+				subprocess.check_call((kind, '-c'), stdin=open(source, 'rb'), stdout=open(target, 'wb'))
+			except Exception, e:
+				print "Cannot create %s:" % target, e
+				continue
+			timings = []
+			for external in (False, True):
+				if external and findHelper(kind) is None:
+					continue
+				if not external:
+					try:
+						decompressorFactory(kind)
+					except (ImportError, IOError), e:
+						print "%-4s in-process  not available:" % ext, e
+						continue
+				start = time.time()
+				events = 0
+				fd = openFile(target, external)
+				for event, elem in iterparse(fd):
+					if elem.tag == 'programme':
+						events += 1
+						elem.clear()
+				fd.close()
+				timings.append((external and 'external' or 'in-process', time.time() - start, events))
+			for how, t, events in timings:
+				print "%-4s %-10s %6.2fs %d events" % (ext, how, t, events)
+			if len(timings) == 2:
+				print "%-4s speedup    %6.2fx" % (ext, timings[0][1] / timings[1][1])
+	finally:
+		shutil.rmtree(workdir)
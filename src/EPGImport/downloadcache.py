@@ -0,0 +1,97 @@
+# On-disk cache of downloaded source and channel files.
+#
+# For every URL the last copy is kept together with its ETag and
+# Last-Modified validators, so the next request can be made conditional.
+# When the server answers "304 Not Modified" the cached copy is used and
+# nothing is transferred.
+#
+import os
+import time
+import cPickle as pickle
+from hashlib import md5
+import log
+
+INDEX_FILE = 'index.pkl'
+# Forget entries that have not been used for this long
+MAX_AGE = 7 * 24 * 3600
+
+class DownloadCache:
+	def __init__(self, path):
+		self.path = path
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		self.indexFile = os.path.join(path, INDEX_FILE)
+		try:
+			self.index = pickle.load(open(self.indexFile, 'rb'))
+		except Exception, e:
+			self.index = {}
+		self.purge()
+
+	def filename(self, url):
+		ext = os.path.splitext(url)[1]
+		if not ext or len(ext) >= 6:
+			ext = ''
+		return os.path.join(self.path, md5(url).hexdigest() + ext)
+
+	def lookup(self, url):
+		'Returns the cached copy of url, or None'
+		entry = self.index.get(url)
+		if entry is None:
+			return None
+		filename = self.filename(url)
+		if not os.path.exists(filename):
+			del self.index[url]
+			return None
+		entry['used'] = time.time()
+		self.save()
+		return filename
+
+	def validators(self, url):
+		'Returns the headers that make a request for url conditional'
+		entry = self.index.get(url)
+		if (entry is None) or not os.path.exists(self.filename(url)):
+			return {}
+		headers = {}
+		if entry.get('etag'):
+			headers['If-None-Match'] = entry['etag']
+		if entry.get('modified'):
+			headers['If-Modified-Since'] = entry['modified']
+		return headers
+
+	def store(self, url, filename, etag=None, modified=None):
+		"""Moves a completed download into the cache and returns the cached
+		name. Returns None when the server sent no validators, the caller
+		keeps its file then."""
+		if not (etag or modified):
+			if self.index.pop(url, None) is not None:
+				self.save()
+			return None
+		target = self.filename(url)
+		os.rename(filename, target)
+		self.index[url] = {'etag': etag, 'modified': modified, 'used': time.time()}
+		self.save()
+		return target
+
+	def purge(self):
+		now = time.time()
+		for url, entry in self.index.items():
+			if entry['used'] + MAX_AGE < now:
+				print>>log, "[EPGImport] Removing stale cached download", url
+				try:
+					os.unlink(self.filename(url))
+				except:
+					pass
+				del self.index[url]
+		# Leftovers of interrupted transfers
+		for fn in os.listdir(self.path):
+			if fn.startswith('epgimport.'):
+				try:
+					os.unlink(os.path.join(self.path, fn))
+				except:
+					pass
+
+	def save(self):
+		try:
+			pickle.dump(self.index, open(self.indexFile, 'wb'), pickle.HIGHEST_PROTOCOL)
+		except Exception, e:
+			print>>log, "[EPGImport] Failed to save download cache index:", e
@@ -8,6 +8,7 @@ import sys
 import codecs
 import struct
 from datetime import datetime
+from eventbuffer import EventBuffer
 
 try:
 	import dreamcrc
@@ -130,9 +131,8 @@ class epgdat_class:
 	# as total events container postprocessed
 	EPGDAT_HASH_EVENT_MEMORY_CONTAINER={}
 
-	# initialize an empty dictionary (Python array)
-	# as channel events container before preprocessing
-	events=[]
+	# channel events container before preprocessing, see eventbuffer.py
+	events=None
 
 	# initialize an empty dictionary (Python array)
 	# the following format can handle duplicated channel name
@@ -147,6 +147,7 @@ class epgdat_class:
 
 	def __init__(self,tmp_path,lamedb_path,epgdat_path):
 		self.EPGDAT_FILENAME=epgdat_path
+		self.events=EventBuffer()
 		self.EPGDAT_TMP_FILENAME=os.path.join(tmp_path,self.EPGDAT_TMP_FILENAME)
 		self.EPG_TMP_FD=open(self.EPGDAT_TMP_FILENAME,"wb")
 		self.LAMEDB=lamedb_path
@@ -189,10 +190,18 @@ class epgdat_class:
 
 	def add_event(self, starttime, duration, title, description, language=""):
 		#print "add event : ",event_starttime_unix_gmt, "title : " ,event_title
-		self.events.append((starttime, duration, self.short_desc(title[:240]), self.long_desc(description)))
+		self.add_events(((starttime, duration, title, description, language),))
+
+	def add_events(self, events):
+		'events are (starttime, duration, title, description, language) tuples'
+		# descriptions are assembled per channel in preprocess_events_channel
+		self.events.extend([(e[0], e[1], e[2][:240], '', e[3], 0, e[4]) for e in events])
 
 	def preprocess_events_channel(self, services):
 		EPG_EVENT_DATA_id = 0
+		# the same title or description is assembled only once per channel
+		short_descs = {}
+		long_descs = {}
 		for service in services:
 			# skip empty lines, they make a mess
 			if not service.strip():
@@ -210,11 +219,13 @@ class epgdat_class:
 			s_BB = self.s_BB
 			s_BBB = self.s_BBB
 			s_I = self.s_I
-			for event in events:
+			for starttime, duration, title, subtitle, description, category, language in events:
 				# **** (1) : create DESCRIPTION HEADER / DATA ****
 				EPG_EVENT_HEADER_datasize = 0
 				# short description (title) type 0x4d
-				short_d = event[2]
+				short_d = short_descs.get(title)
+				if short_d is None:
+					short_d = short_descs[title] = self.short_desc(title)
 				EPG_EVENT_HEADER_datasize += 4  # add 4 bytes for a sigle REF DESC (CRC32)
 				#if not epg_event_description_dict.has_key(short_d[0]):
 				#if not exist_event(short_d[0]) :
@@ -230,7 +241,9 @@ class epgdat_class:
 					#increment_event(short_d[0])
 					self.EPGDAT_HASH_EVENT_MEMORY_CONTAINER[short_d[0]][1] += 1
 				# long description type 0x4e
-				long_d = event[3]
+				long_d = long_descs.get(description)
+				if long_d is None:
+					long_d = long_descs[description] = self.long_desc(description)
 				EPG_EVENT_HEADER_datasize += 4 * len(long_d) # add 4 bytes for a single REF DESC (CRC32)
 				for desc in long_d:
 					#if not epg_event_description_dict.has_key(long_d[i][0]):
@@ -252,8 +265,8 @@ class epgdat_class:
 				self.EPG_TMP_FD.write(pack_1)
 				# extract date and time from <event>
 				# unix format (second since 1970) and already GMT corrected
-				event_time_HMS=datetime.utcfromtimestamp(event[0])
-				event_length_HMS=datetime.utcfromtimestamp(event[1])
+				event_time_HMS=datetime.utcfromtimestamp(starttime)
+				event_length_HMS=datetime.utcfromtimestamp(duration)
 				# epg.dat date is = (proleptic date - epg_zero_day)
 				dvb_date = event_time_HMS.toordinal() - self.EPG_PROLEPTIC_ZERO_DAY
 				# EVENT DATA
@@ -269,7 +282,7 @@ class epgdat_class:
 				self.EPG_TMP_FD.write(pack_1+pack_2+pack_3+pack_4)
 		# reset again event container
 		self.EPG_TOTAL_EVENTS += len(self.events)
-		self.events=[]
+		self.events=EventBuffer()
 
 	def final_process(self):
 		if self.EPG_TOTAL_EVENTS > 0:
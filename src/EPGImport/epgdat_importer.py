@@ -5,8 +5,7 @@ if os.path.exists("/var/lib/dpkg/status"):
 else:                                
         import epgdat     
 import sys
-
-import sys
+import staging
 # Hack to make this test run on Windows (where the reactor cannot handle files)
 if sys.platform.startswith('win'):
 	tmppath = '.'
@@ -16,18 +15,18 @@ else:
 	settingspath = '/etc/enigma2'
 
 class epgdatclass:
+	# Each channel is written as one record, see grouping.py
+	groupByService = True
+
 	def __init__(self):
 		self.data = None
 		self.services = None
+		self.delta = None
 		path = tmppath
-		if self.checkPath('/media/cf'):
-			path='/media/cf'
-		if self.checkPath('/media/mmc'):
-			path='/media/mmc'
-		if self.checkPath('/media/usb'):
-			path='/media/usb'
-		if self.checkPath('/media/hdd'):
-			path='/media/hdd'
+		for location in ('/media/hdd', '/media/usb', '/media/mmc', '/media/cf'):
+			if self.checkPath(location):
+				path = location
+				break
 		if os.path.exists("/var/lib/dpkg/status"):    
     			from Components.config import config    
     			self.epgdbfile = config.misc.epgcache_filename.value    
@@ -38,39 +37,60 @@ class epgdatclass:
 		else:
 			self.epgfile = os.path.join(path, 'epg_new.dat')
 			self.epg = epgdat.epgdat_class(path, settingspath, self.epgfile)
+		# epg.db keeps the previous import, epg.dat is written anew
+		self.acceptsDelta = hasattr(self.epg, 'apply_delta')
 
-	def importEvents(self, services, dataTupleList):
-		'This method is called repeatedly for each bit of data'
+	def importEvents(self, services, dataTupleList, delta=None):
+		'''This method is called repeatedly for each bit of data. delta is the
+		snapshot.Delta of all the events of services, given in a single call.'''
 		if services != self.services:
 			self.commitService()
 			self.services = services
+			self.delta = delta
+		else:
+			# The delta does not cover these events
+			self.delta = None
+		events = []
 		for program in dataTupleList:
 			if program[3]:
 				desc = program[3] + '\n' + program[4]
 			else:
 				desc = program[4]
-			self.epg.add_event(program[0], program[1], program[2], desc, program[6])
+			events.append((program[0], program[1], program[2], desc, program[6]))
+		self.epg.add_events(events)
 
 	def commitService(self):
-		if self.services is not None:
-			self.epg.preprocess_events_channel(self.services)
+		'''Writes the events of the last services. Also called by the importer
+		right after importEvents, so that a failure shows up with its services.'''
+		services = self.services
+		delta = self.delta
+		# Not tried a second time, whatever happens
+		self.services = None
+		self.delta = None
+		if services is not None:
+			if delta is not None:
+				self.epg.apply_delta(services, delta)
+			else:
+				self.epg.preprocess_events_channel(services)
 
 	def epg_done(self):
+		'Writes what is left, returns False when that failed'
+		if self.epg is None:
+			return True
 		try:
 			self.commitService()
 			self.epg.final_process()
+			return True
 		except:
 			print "[EPGImport] Failure in epg_done"
 			import traceback
 			traceback.print_exc()
-		self.epg = None
+			return False
+		finally:
+			self.epg = None
 
 	def checkPath(self,path):
-		f = os.popen('mount', "r")
-		for l in f.xreadlines():
-			if l.find(path)!=-1:
-				return True
-		return False
+		return staging.getManager().isMounted(path)
 
 	def __del__(self):
 		'Destructor - finalize the file when done'
@@ -35,6 +35,7 @@ from ServiceReference import ServiceReference
 from sqlite3 import dbapi2 as sqlite
 from Components.config import config
 from enigma import eTimer
+from eventbuffer import EventBuffer
 GREENC =  '\033[32m'
 ENDC = '\033[m'                                                                 
                                                                                 
@@ -47,12 +48,12 @@ class epgdb_class:
 	EPG_TOTAL_EVENTS=0
 	EXCLUDED_SID=[]
 
-	# initialize an empty dictionary (Python array)
-	# as channel events container before preprocessing
-	events=[]
+	# channel events container before preprocessing, see eventbuffer.py
+	events=None
 
 	def __init__(self,provider_name,provider_priority,epgdb_path=None,clear_oldepg=False):
 		self.source_name=provider_name
+		self.events=EventBuffer()
 		self.priority=provider_priority
 		# get timespan time from system settings defined in days
 		# get outdated time from system settings defined in hours
@@ -63,6 +64,7 @@ class epgdb_class:
 		self.epg_timespan = int(config.misc.epgcache_timespan.value)
 		self.epg_cutoff_time=int(time.time())+(self.epg_timespan*86400)
 		self.event_counter_journal = 0
+		self.event_kept_journal = 0
 		self.events_in_past_journal = 0
 		self.events_in_import_range_journal = 0
 		self.epgdb_path=config.misc.epgcache_filename.value
@@ -156,16 +158,51 @@ class epgdb_class:
 		self.EXCLUDED_SID=exsidlist
 
 	def add_event(self, starttime, duration, title, description, language):
-		self.events.append((starttime, duration, title[:240], description, language))
+		self.add_events(((starttime, duration, title, description, language),))
 
-	def preprocess_events_channel(self, services=None):
+	def add_events(self, events):
+		'events are (starttime, duration, title, description, language) tuples'
+		self.events.extend([(e[0], e[1], e[2][:240], '', e[3], 0, e[4]) for e in events])
+
+	def apply_delta(self, services, delta):
+		'Like preprocess_events_channel, but only writes what changed since the last import, see snapshot.py'
+		self.preprocess_events_channel(services, delta)
+
+	def remove_changed(self, cursor_event, delta):
+		'Deletes the events of the service that are not kept, returns the events still to be inserted'
+		cursor_event.execute("DELETE FROM T_Event WHERE service_id=? AND source_id IS NOT ?", (self.service_id, self.source_id))
+		cursor_event.execute("SELECT id, begin_time FROM T_Event WHERE service_id=?", (self.service_id,))
+		existing = {}
+		obsolete = []
+		for event_id, begin_time in cursor_event.fetchall():
+			if begin_time in existing:
+				obsolete.append(event_id)
+			else:
+				existing[begin_time] = event_id
+		starts = self.events.start
+		keep = set()
+		rows = list(delta.changed)
+		for row in delta.kept:
+			if starts[row] in existing:
+				keep.add(starts[row])
+			else:
+				# not in epg.db (any more), so it is written like a new one
+				rows.append(row)
+		obsolete.extend([event_id for begin_time, event_id in existing.items() if begin_time not in keep])
+		# triggers will clean up the rest ... hopefully ...
+		cursor_event.executemany("DELETE FROM T_Event WHERE id=?", [(event_id,) for event_id in obsolete])
+		self.event_kept_journal = len(keep)
+		rows.sort()
+		return self.events.select(rows)
+
+	def preprocess_events_channel(self, services=None, delta=None):
                 if self.connection is None:
                         cprint("NOT YET CONNECTED")
 			self.size=os_path.getsize(self.epgdb_path) # to continue immediately
                         self.start_process()
 		if services is None:
 			# reset event container
-			self.events=[]
+			self.events=EventBuffer()
 			return
 #               cprint("EVENTS: %d" % len(self.events))
 		# one local cursor per table seems to perform slightly better ...
@@ -215,18 +252,22 @@ class epgdb_class:
 					cursor_service.execute(cmd, (self.sid,self.tsid,self.onid,self.dvbnamespace))
 					self.service_id=cursor_service.lastrowid
 
-				# triggers will clean up the rest ... hopefully ...
-                                cmd = "DELETE FROM T_Event where service_id=%d" % self.service_id
-                                cursor_event.execute(cmd)
-				# now we go through all the events for this channel/service_id and add them ...
 				self.event_counter_journal = 0
-				events = self.events
+				self.event_kept_journal = 0
+				if delta is not None:
+					events = self.remove_changed(cursor_event, delta)
+				else:
+					# triggers will clean up the rest ... hopefully ...
+					cmd = "DELETE FROM T_Event where service_id=%d" % self.service_id
+					cursor_event.execute(cmd)
+					events = self.events
+				# now we go through all the events for this channel/service_id and add them ...
 				for event in events:
 					# short description (title)
 					self.short_d = event[2]
 					# extended description 
-					if len(event[3]) > 0:
-						self.long_d = event[3]
+					if len(event[4]) > 0:
+						self.long_d = event[4]
 					else:
 						self.long_d = event[2]
 					self.extended_d = self.long_d
@@ -239,7 +280,7 @@ class epgdb_class:
 					self.duration=int(event[1])
 					if self.duration < 1:
 						self.duration=1
-					self.language=event[4]
+					self.language=event[6]
 					# we need hash values for descriptions, hash is provided by enigma 
 					self.short_hash=eEPGCache.getStringHash(self.short_d) 
 					self.long_hash=eEPGCache.getStringHash(self.long_d) 
@@ -294,11 +335,11 @@ class epgdb_class:
                                         else:
                                                 self.events_in_past_journal += 1
 
-			cprint("ADDED %d from %d events for channel %s" % (self.event_counter_journal, number_of_events, channel))
+			cprint("ADDED %d from %d events for channel %s, %d unchanged" % (self.event_counter_journal, number_of_events, channel, self.event_kept_journal))
 			self.EPG_TOTAL_EVENTS += number_of_events
 
 		# reset event container
-		self.events=[]
+		self.events=EventBuffer()
 		cursor_service.close()
 		cursor_event.close()
 		cursor_title.close()
@@ -0,0 +1,285 @@
+#
+# Compact storage for lots of events.
+#
+# A list of event tuples costs a tuple, two ints and up to five strings
+# per programme. An EventBuffer keeps the numbers in arrays and the texts
+# as references into a string table, where every distinct text is stored
+# once. Reading it back gives the usual parser tuples:
+# (start, duration, title, subtitle, description, category, language)
+#
+from array import array
+from itertools import izip
+
+# Bytes per event in the columns
+ROW_SIZE = 4 + 4 + 1 + 4 * 4
+# Rough size of a string object and its table entries, without the text
+STRING_OVERHEAD = 100
+
+COLUMNS = (
+	('start', 'I'),
+	('duration', 'i'),
+	('title', 'I'),
+	('subtitle', 'I'),
+	('description', 'I'),
+	('category', 'B'),
+	('language', 'I'),
+)
+TEXT_COLUMNS = ('title', 'subtitle', 'description', 'language')
+
+class StringTable:
+	'Every distinct string once, referred to by its number'
+	def __init__(self):
+		self.strings = []
+		self.index = {}
+		# estimated bytes in use
+		self.size = 0
+
+	def add(self, s):
+		i = self.index.get(s)
+		if i is None:
+			i = self.index[s] = len(self.strings)
+			self.strings.append(s)
+			self.size += len(s) + STRING_OVERHEAD
+		return i
+
+	def __len__(self):
+		return len(self.strings)
+
+class EventBuffer:
+	'''Events in array columns. Several buffers may share one StringTable,
+	e.g. all the channels of an import.'''
+	def __init__(self, strings=None):
+		# A table of its own holds no strings of other buffers
+		self.ownStrings = strings is None
+		if strings is None:
+			strings = StringTable()
+		self.strings = strings
+		for name, typecode in COLUMNS:
+			setattr(self, name, array(typecode))
+
+	def append(self, event):
+		self.extend((event,))
+
+	def extend(self, events):
+		'Appends event tuples, or the events of another EventBuffer'
+		if isinstance(events, EventBuffer):
+			self.extendBuffer(events)
+			return
+		table = self.strings
+		index = table.index
+		strings = table.strings
+		size = 0
+		starts = self.start.append
+		durations = self.duration.append
+		titles = self.title.append
+		subtitles = self.subtitle.append
+		descriptions = self.description.append
+		categories = self.category.append
+		languages = self.language.append
+		# Written out in full, this is the hot loop of an import
+		for start, duration, title, subtitle, description, category, language in events:
+			# Other parsers may produce float times
+			start = int(start)
+			starts((start > 0) and start or 0)
+			durations(int(duration))
+			i = index.get(title)
+			if i is None:
+				i = index[title] = len(strings)
+				strings.append(title)
+				size += len(title) + STRING_OVERHEAD
+			titles(i)
+			i = index.get(subtitle)
+			if i is None:
+				i = index[subtitle] = len(strings)
+				strings.append(subtitle)
+				size += len(subtitle) + STRING_OVERHEAD
+			subtitles(i)
+			i = index.get(description)
+			if i is None:
+				i = index[description] = len(strings)
+				strings.append(description)
+				size += len(description) + STRING_OVERHEAD
+			descriptions(i)
+			if (category.__class__ is not int) or not (0 <= category <= 255):
+				category = 0
+			categories(category)
+			i = index.get(language)
+			if i is None:
+				i = index[language] = len(strings)
+				strings.append(language)
+				size += len(language) + STRING_OVERHEAD
+			languages(i)
+		table.size += size
+
+	def extendBuffer(self, events):
+		if events.strings is self.strings:
+			for name, typecode in COLUMNS:
+				getattr(self, name).extend(getattr(events, name))
+			return
+		self.start.extend(events.start)
+		self.duration.extend(events.duration)
+		self.category.extend(events.category)
+		# Each string of the other table is looked up here only once
+		mapping = {}
+		strings = events.strings.strings
+		add = self.strings.add
+		for name in TEXT_COLUMNS:
+			column = getattr(self, name)
+			for i in getattr(events, name):
+				j = mapping.get(i)
+				if j is None:
+					j = mapping[i] = add(strings[i])
+				column.append(j)
+
+	def __len__(self):
+		return len(self.start)
+
+	def __iter__(self):
+		strings = self.strings.strings
+		for start, duration, title, subtitle, description, category, language in izip(self.start, self.duration,
+				self.title, self.subtitle, self.description, self.category, self.language):
+			yield (start, duration, strings[title], strings[subtitle], strings[description], category, strings[language])
+
+	def __getitem__(self, i):
+		strings = self.strings.strings
+		return (self.start[i], self.duration[i], strings[self.title[i]], strings[self.subtitle[i]],
+			strings[self.description[i]], self.category[i], strings[self.language[i]])
+
+	def tuples(self):
+		'The events as a list of tuples, for eEPGCache.importEvents'
+		return list(self)
+
+	def part(self, begin, end):
+		'Events begin..end as a buffer on the same string table'
+		result = EventBuffer(self.strings)
+		for name, typecode in COLUMNS:
+			setattr(result, name, getattr(self, name)[begin:end])
+		return result
+
+	def clearDescriptions(self, after):
+		'Drops the long description of the events starting after the time after'
+		empty = self.strings.add('')
+		description = self.description
+		i = 0
+		for start in self.start:
+			if start > after:
+				description[i] = empty
+			i += 1
+
+	def select(self, rows):
+		'The events of the numbered rows, in that order, on the same string table'
+		result = EventBuffer(self.strings)
+		for name, typecode in COLUMNS:
+			column = getattr(self, name)
+			setattr(result, name, array(typecode, [column[i] for i in rows]))
+		return result
+
+	def sortByStart(self):
+		start = self.start
+		order = sorted(xrange(len(start)), key=start.__getitem__)
+		for name, typecode in COLUMNS:
+			column = getattr(self, name)
+			setattr(self, name, array(typecode, [column[i] for i in order]))
+
+	def within(self, earliest, latest):
+		'The events that end at or after earliest and start at or before latest'
+		rows = []
+		i = 0
+		for start, duration in izip(self.start, self.duration):
+			if (start <= latest) and (start + duration >= earliest):
+				rows.append(i)
+			i += 1
+		if len(rows) == len(self.start):
+			return self
+		return self.select(rows)
+
+	def memory(self):
+		'Estimated bytes in use, including the whole string table'
+		return ROW_SIZE * len(self.start) + self.strings.size
+
+	def __getstate__(self):
+		state = {}
+		if self.ownStrings:
+			table = self.strings
+			for name, typecode in COLUMNS:
+				state[name] = getattr(self, name).tostring()
+		else:
+			# Only the strings this buffer uses, the table is shared
+			strings = self.strings.strings
+			table = StringTable()
+			add = table.add
+			for name, typecode in COLUMNS:
+				column = getattr(self, name)
+				if name in TEXT_COLUMNS:
+					column = array(typecode, [add(strings[i]) for i in column])
+				state[name] = column.tostring()
+		state['strings'] = table.strings
+		state['size'] = table.size
+		return state
+
+	def __setstate__(self, state):
+		self.ownStrings = True
+		self.strings = StringTable()
+		strings = state['strings']
+		self.strings.strings = strings
+		self.strings.index = dict(izip(strings, xrange(len(strings))))
+		self.strings.size = state['size']
+		for name, typecode in COLUMNS:
+			column = array(typecode)
+			column.fromstring(state[name])
+			setattr(self, name, column)
+
+if __name__ == '__main__':
+	# Memory per 100k events, as a list of tuples and as an EventBuffer.
+	# Each variant is measured in a child process of its own.
+	import os
+	import sys
+	import resource
+	import random
+	import cPickle
+
+	titles = ['Title %d' % i for i in xrange(2000)]
+
+	def makeEvents(count):
+		# Repeated titles and languages, mostly unique descriptions, like
+		# real data. Every string is a new object, as the parser makes them.
+		random.seed(1)
+		for i in xrange(count):
+			yield (1704067200 + i * 900, 900, (random.choice(titles) + ' ')[:-1],
+				random.choice(('', 'Aflevering %d' % (i % 50))),
+				'Beschrijving van programma %d, wat langer zodat het op echte gegevens lijkt.' % i,
+				random.choice((0x10, 0x20, 0x40)), (random.choice(('dut', 'eng')) + ' ')[:-1])
+
+	def rss():
+		for line in open('/proc/self/status'):
+			if line.startswith('VmRSS:'):
+				return int(line.split()[1]) * 1024
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+	def measure(kind, count):
+		before = rss()
+		if kind == 'tuples':
+			kept = list(makeEvents(count))
+		else:
+			kept = EventBuffer()
+			kept.extend(makeEvents(count))
+		return rss() - before, kept
+
+	count = 100000
+	if len(sys.argv) > 1:
+		# child: report the bytes kept alive by one variant
+		used, kept = measure(sys.argv[1], count)
+		print used
+		sys.exit(0)
+	results = {}
+	for kind in ('tuples', 'buffer'):
+		pipe = os.popen('%s %s %s' % (sys.executable, sys.argv[0], kind))
+		results[kind] = int(pipe.read())
+		pipe.close()
+	buffer = EventBuffer()
+	buffer.extend(makeEvents(count))
+	print "Memory per %d events:" % count
+	print "  list of tuples %8.1f MB" % (results['tuples'] / 1048576.0)
+	print "  EventBuffer    %8.1f MB (estimate %.1f MB)" % (results['buffer'] / 1048576.0, buffer.memory() / 1048576.0)
+	print "  Same events: %s" % (list(buffer) == list(makeEvents(count)))
+	print "  Pickled: tuples %d bytes, buffer %d bytes" % (len(cPickle.dumps(list(makeEvents(count)), 2)), len(cPickle.dumps(buffer, 2)))
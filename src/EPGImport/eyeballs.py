@@ -0,0 +1,193 @@
+# Dual stack connection establishment in the style of RFC 8305
+# ("Happy Eyeballs").
+#
+# The host name is resolved without blocking the reactor. Connection
+# attempts to the resulting addresses are started one after the other
+# with a short stagger, alternating between IPv6 and IPv4, and without
+# waiting for earlier attempts to time out. The first connection that
+# is established is handed to the real protocol factory, the other
+# attempts are abandoned. The address family that won is remembered per
+# host and tried first next time.
+#
+import time
+from socket import getaddrinfo, AF_INET, AF_INET6, AF_UNSPEC, SOCK_STREAM, has_ipv6
+from twisted.internet import reactor, defer, protocol, threads, error
+from twisted.python import failure
+import twisted.python.runtime
+import log
+
+# Delay before the next attempt is started (RFC 8305 recommends 250ms)
+CONNECTION_ATTEMPT_DELAY = 0.25
+CONNECT_TIMEOUT = 30
+# getaddrinfo does not tell the TTL, keep results for a few minutes
+RESOLVE_TTL = 300
+FAMILY_TTL = 24 * 3600
+
+addressCache = {}
+familyCache = {}
+
+def _lookup(host, port):
+	result = []
+	for family, socktype, proto, canonname, sockaddr in getaddrinfo(host, port, AF_UNSPEC, SOCK_STREAM):
+		if (family == AF_INET6) and not has_ipv6:
+			continue
+		if family in (AF_INET, AF_INET6):
+			entry = (family, sockaddr[0])
+			if entry not in result:
+				result.append(entry)
+	return result
+
+def resolve(host, port):
+	'Returns a Deferred firing with a list of (family, address)'
+	cached = addressCache.get((host, port))
+	if (cached is not None) and (cached[1] > time.time()):
+		return defer.succeed(cached[0])
+	if twisted.python.runtime.platform.supportsThreads():
+		d = threads.deferToThread(_lookup, host, port)
+	else:
+		d = defer.execute(_lookup, host, port)
+	def store(addresses):
+		addressCache[(host, port)] = (addresses, time.time() + RESOLVE_TTL)
+		return addresses
+	return d.addCallback(store)
+
+def preferredFamily(host):
+	cached = familyCache.get(host)
+	if (cached is not None) and (cached[1] > time.time()):
+		return cached[0]
+	return AF_INET6
+
+def sortAddresses(host, addresses):
+	'Interleaves the address families, starting with the preferred one'
+	first = preferredFamily(host)
+	preferred = [a for a in addresses if a[0] == first]
+	others = [a for a in addresses if a[0] != first]
+	result = []
+	while preferred or others:
+		if preferred:
+			result.append(preferred.pop(0))
+		if others:
+			result.append(others.pop(0))
+	return result
+
+class _AttemptProtocol(protocol.Protocol):
+	'Passes everything on to the real protocol once this attempt has won'
+	wrapped = None
+
+	def connectionMade(self):
+		if not self.factory.race.won(self.factory):
+			self.transport.loseConnection()
+			return
+		self.wrapped = self.factory.race.factory.buildProtocol(self.transport.getPeer())
+		self.wrapped.makeConnection(self.transport)
+
+	def dataReceived(self, data):
+		if self.wrapped is not None:
+			self.wrapped.dataReceived(data)
+
+	def connectionLost(self, reason):
+		if self.wrapped is not None:
+			self.wrapped.connectionLost(reason)
+
+class _AttemptFactory(protocol.ClientFactory):
+	protocol = _AttemptProtocol
+
+	def __init__(self, race, family, address):
+		self.race = race
+		self.family = family
+		self.address = address
+		self.connector = None
+
+	def clientConnectionFailed(self, connector, reason):
+		self.race.attemptFailed(self, reason)
+
+class Connector:
+	"""Connects factory to host:port over whatever address family works
+	first. Behaves enough like a twisted connector for HTTPClientFactory."""
+	def __init__(self, host, port, factory, contextFactory=None, timeout=CONNECT_TIMEOUT):
+		self.host = host
+		self.port = port
+		self.factory = factory
+		self.contextFactory = contextFactory
+		self.timeout = timeout
+		self.attempts = []
+		self.addresses = []
+		self.winner = None
+		self.stopped = False
+		self.nextCall = None
+		self.lastFailure = None
+		resolve(host, port).addCallbacks(self.resolved, self.fail)
+
+	def resolved(self, addresses):
+		if self.stopped:
+			return
+		if not addresses:
+			self.fail(failure.Failure(error.DNSLookupError(self.host)))
+			return
+		self.addresses = sortAddresses(self.host, addresses)
+		self.startAttempt()
+
+	def startAttempt(self):
+		self.nextCall = None
+		if self.stopped or (self.winner is not None) or not self.addresses:
+			return
+		family, address = self.addresses.pop(0)
+		attempt = _AttemptFactory(self, family, address)
+		if self.contextFactory is not None:
+			attempt.connector = reactor.connectSSL(address, self.port, attempt, self.contextFactory, self.timeout)
+		else:
+			attempt.connector = reactor.connectTCP(address, self.port, attempt, self.timeout)
+		self.attempts.append(attempt)
+		if self.addresses:
+			self.nextCall = reactor.callLater(CONNECTION_ATTEMPT_DELAY, self.startAttempt)
+
+	def won(self, attempt):
+		if self.stopped or (self.winner is not None):
+			return False
+		self.winner = attempt
+		familyCache[self.host] = (attempt.family, time.time() + FAMILY_TTL)
+		print>>log, "[EPGImport] Connected to %s via %s" % (self.host, attempt.family == AF_INET6 and "IPv6" or "IPv4")
+		self.cancelPending(attempt)
+		return True
+
+	def attemptFailed(self, attempt, reason):
+		if attempt in self.attempts:
+			self.attempts.remove(attempt)
+		self.lastFailure = reason
+		if self.stopped or (self.winner is not None):
+			return
+		if self.addresses:
+			# No need to wait for the stagger, the next one goes now
+			if self.nextCall is not None:
+				self.nextCall.cancel()
+			self.startAttempt()
+		elif not self.attempts:
+			self.fail(reason)
+
+	def cancelPending(self, keep=None):
+		if self.nextCall is not None:
+			self.nextCall.cancel()
+			self.nextCall = None
+		self.addresses = []
+		for attempt in self.attempts:
+			if attempt is not keep:
+				try:
+					attempt.connector.stopConnecting()
+				except Exception:
+					# connected meanwhile, _AttemptProtocol drops it
+					pass
+
+	def fail(self, reason):
+		if self.stopped:
+			return
+		self.stopped = True
+		self.cancelPending()
+		self.factory.clientConnectionFailed(self, reason)
+
+	def stopConnecting(self):
+		if self.winner is not None:
+			raise error.NotConnectingError()
+		self.fail(failure.Failure(error.UserError()))
+
+def connect(host, port, factory, contextFactory=None, timeout=CONNECT_TIMEOUT):
+	return Connector(host, port, factory, contextFactory, timeout)
@@ -27,13 +27,27 @@ def new():
 	return Gen_Xmltv()
 
 class Gen_Xmltv():
+	# Set to leave logging the skipped programmes to the caller
+	quiet = False
+	# The converter of the last iterator, it holds the skip counts
+	converter = None
+	# Set when the last iterator ended on an error
+	failed = False
+
 	def iterator(self, fd, channelsDict):
+		self.failed = False
 		try:
 			xmltv_parser = xmltvconverter.XMLTVConverter(channelsDict, gen_categories, date_format)
+			xmltv_parser.quiet = self.quiet
+			self.converter = xmltv_parser
 			for r in xmltv_parser.enumFile(fd):
 				yield r
 		except Exception, e:
+			self.failed = True
 			print "[gen_xmltv] Error:", e
 			import traceback
 			traceback.print_exc()
 
+	def batches(self, fd, channelsDict):
+		return xmltvconverter.batchEvents(self.iterator(fd, channelsDict))
+
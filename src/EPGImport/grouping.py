@@ -0,0 +1,88 @@
+#
+# Groups the events of a whole import per service before they are stored.
+#
+# XMLTV files are often ordered by time, not by channel, so the parser
+# delivers the channels interleaved. Storage backends that write one
+# record per channel (epg.dat, epg.db) want every channel exactly once.
+# Events are kept in memory up to a budget, beyond that they are spilled
+# to a temporary file on disk.
+#
+import os
+import tempfile
+import cPickle
+import log
+import staging
+from eventbuffer import EventBuffer, StringTable, ROW_SIZE
+
+# Bytes of events kept in memory before spilling to disk
+MEMORY_BUDGET = 16 * 1024 * 1024
+# Spill files do not belong in RAM
+SPILL_MIN_FREE = 100000000
+
+def spillDirectory():
+	return staging.getManager().mounted(SPILL_MIN_FREE, *staging.DISK_LOCATIONS) or staging.DEFAULT_LOCATION
+
+class EventGrouper:
+	'Collects (services, events) and hands them out once per services, sorted'
+	def __init__(self, budget=MEMORY_BUDGET):
+		self.budget = budget
+		self.services = {}
+		self.events = {}
+		# One string table for all buffered channels, titles repeat a lot
+		self.strings = StringTable()
+		self.rows = 0
+		self.spillFile = None
+		self.spilled = {}
+		self.count = 0
+
+	def add(self, services, events):
+		key = tuple(services)
+		buffered = self.events.get(key)
+		if buffered is None:
+			if key not in self.services:
+				self.services[key] = services
+			buffered = self.events[key] = EventBuffer(self.strings)
+		buffered.extend(events)
+		self.count += len(events)
+		self.rows += len(events)
+		if ROW_SIZE * self.rows + self.strings.size > self.budget:
+			self.spill()
+
+	def spill(self):
+		if self.spillFile is None:
+			path = spillDirectory()
+			print>>log, "[EPGImport] Grouping more than %d bytes of events, spilling to %s" % (self.budget, path)
+			self.spillFile = tempfile.TemporaryFile(prefix='epgimport', dir=path)
+		f = self.spillFile
+		f.seek(0, os.SEEK_END)
+		for key, events in self.events.iteritems():
+			self.spilled.setdefault(key, []).append(f.tell())
+			cPickle.dump(events, f, cPickle.HIGHEST_PROTOCOL)
+		self.events = {}
+		self.strings = StringTable()
+		self.rows = 0
+
+	def groups(self):
+		'Yields (services, events) for every services once, ordered by service reference'
+		f = self.spillFile
+		for key in sorted(self.services.iterkeys()):
+			offsets = self.spilled.pop(key, ())
+			if offsets:
+				events = EventBuffer()
+				for offset in offsets:
+					f.seek(offset)
+					events.extend(cPickle.load(f))
+				events.extend(self.events.pop(key, ()))
+			else:
+				events = self.events.pop(key)
+			events.sortByStart()
+			yield self.services[key], events
+
+	def close(self):
+		if self.spillFile is not None:
+			self.spillFile.close()
+			self.spillFile = None
+		self.services = {}
+		self.events = {}
+		self.strings = StringTable()
+		self.spilled = {}
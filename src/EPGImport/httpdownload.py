@@ -0,0 +1,196 @@
+# HTTP transfers for the importer.
+#
+# twisted's downloadPage() hides the factory that does the work, so the
+# response headers of a transfer cannot be inspected afterwards. This
+# makes the same request, but the Deferred fires with the factory.
+#
+import os
+import time
+from urlparse import urlsplit
+from twisted.python.failure import Failure
+from twisted.web.client import HTTPDownloader
+import eyeballs
+
+class ResumeMismatch(Exception):
+	'The server offered the rest of a different file than the one being resumed'
+	pass
+
+class Downloader(HTTPDownloader):
+	'HTTPDownloader that keeps hold of its connection, so it can act as a producer'
+	protocolInstance = None
+	connector = None
+	aborted = False
+	firstByte = None
+	finished = None
+	received = 0
+	mismatch = False
+
+	def __init__(self, url, fileOrName, *args, **kwargs):
+		# When resuming, the size the complete file must have
+		self.expectedLength = kwargs.pop('expectedLength', None)
+		# Called with the factory once the response headers are in, returns
+		# the name of the file to write, so its size can decide where it goes
+		self.placeFile = kwargs.pop('placeFile', None)
+		if fileOrName is None:
+			fileOrName = ''
+		HTTPDownloader.__init__(self, url, fileOrName, *args, **kwargs)
+		self.started = time.time()
+
+	def buildProtocol(self, addr):
+		p = HTTPDownloader.buildProtocol(self, addr)
+		self.protocolInstance = p
+		return p
+
+	def pageStart(self, partialContent):
+		self.firstByte = time.time()
+		if partialContent and (self.expectedLength is not None) and (totalLength(self) != self.expectedLength):
+			# Some other file, do not append to the partial copy
+			self.mismatch = True
+			self.noPage(Failure(ResumeMismatch(self.url)))
+			self.abort()
+			return
+		HTTPDownloader.pageStart(self, partialContent)
+		# A stream wants to be able to pause the transfer
+		registerProducer = getattr(self.file, 'registerProducer', None)
+		if registerProducer is not None:
+			registerProducer(self)
+
+	def openFile(self, partialContent):
+		if (self.placeFile is not None) and not partialContent:
+			self.fileName = self.placeFile(self)
+		return HTTPDownloader.openFile(self, partialContent)
+
+	def pagePart(self, data):
+		self.received += len(data)
+		HTTPDownloader.pagePart(self, data)
+
+	def pageEnd(self):
+		self.finished = time.time()
+		HTTPDownloader.pageEnd(self)
+
+	def timeToFirstByte(self):
+		if self.firstByte is None:
+			return None
+		return self.firstByte - self.started
+
+	def duration(self):
+		'Seconds spent receiving the body'
+		if (self.firstByte is None) or (self.finished is None):
+			return 0
+		return self.finished - self.firstByte
+
+	def transport(self):
+		if self.protocolInstance is not None:
+			return self.protocolInstance.transport
+		return None
+
+	def pauseProducing(self):
+		transport = self.transport()
+		if transport is not None:
+			transport.pauseProducing()
+
+	def resumeProducing(self):
+		transport = self.transport()
+		if transport is not None:
+			transport.resumeProducing()
+
+	def stopProducing(self):
+		self.abort()
+
+	def abort(self):
+		'Gives up on the transfer, the Deferred errbacks'
+		self.aborted = True
+		transport = self.transport()
+		if transport is not None:
+			transport.loseConnection()
+		elif self.connector is not None:
+			try:
+				self.connector.stopConnecting()
+			except Exception:
+				# connected or failed already
+				pass
+
+def connect(url, factory):
+	parts = urlsplit(url)
+	# hostname strips the brackets from literal IPv6 addresses
+	host = parts.hostname
+	if parts.scheme == 'https':
+		from twisted.internet import ssl
+		return eyeballs.connect(host, parts.port or 443, factory, ssl.ClientContextFactory())
+	return eyeballs.connect(host, parts.port or 80, factory)
+
+def download(url, fileOrName, headers=None, watcher=None, **kwargs):
+	"""Like downloadPage, the result of the Deferred is the Downloader factory.
+	If given, watcher is called with the factory as soon as it exists."""
+	factory = Downloader(url, fileOrName, headers=headers, **kwargs)
+	factory.connector = connect(url, factory)
+	if watcher is not None:
+		watcher(factory)
+	return factory.deferred.addCallback(lambda ignore: factory)
+
+def getHeader(factory, name):
+	'Returns the first value of response header "name", or None'
+	values = getattr(factory, 'response_headers', None) or {}
+	values = values.get(name.lower())
+	if values:
+		return values[0]
+	return None
+
+def totalLength(factory):
+	'Size of the complete file, or None when the server did not tell'
+	contentRange = getHeader(factory, 'content-range')
+	if contentRange is not None:
+		# "bytes 1000-4999/5000", the total may be "*"
+		total = contentRange.rsplit('/', 1)[-1]
+	else:
+		total = getHeader(factory, 'content-length')
+	try:
+		return int(total)
+	except (TypeError, ValueError):
+		return None
+
+class PartialDownload:
+	'What arrived of a broken transfer, kept so that it can be resumed'
+	def __init__(self, url, filename, factory, alternatives=(), previous=None):
+		self.url = url
+		self.filename = filename
+		# Mirrors that should serve the same file
+		self.alternatives = tuple(alternatives)
+		self.attempts = 0
+		self.etag = self.modified = self.length = None
+		if previous is not None:
+			if previous.url == url:
+				self.attempts = previous.attempts
+			self.etag = previous.etag
+			self.modified = previous.modified
+			self.length = previous.length
+		if getattr(factory, 'response_headers', None):
+			self.etag = getHeader(factory, 'etag')
+			self.modified = getHeader(factory, 'last-modified')
+			self.length = totalLength(factory)
+
+	def size(self):
+		try:
+			return os.path.getsize(self.filename)
+		except OSError:
+			return 0
+
+	def usable(self):
+		return (self.length is not None) and (0 < self.size() < self.length)
+
+	def matches(self, url):
+		return (url == self.url) or (url in self.alternatives)
+
+	def headers(self):
+		'If-Range makes the server send the whole file if it changed'
+		if self.etag and not self.etag.startswith('W/'):
+			return {'if-range': self.etag}
+		if self.modified:
+			return {'if-range': self.modified}
+		return {}
+
+	def discard(self):
+		try:
+			os.unlink(self.filename)
+		except OSError:
+			pass
@@ -0,0 +1,145 @@
+# Racing a download on several mirrors.
+#
+# The same file is requested from a few mirrors at once. The first one
+# to reach a useful throughput wins and the others are cancelled, so a
+# slow mirror no longer costs minutes of tail latency.
+#
+import time
+from twisted.internet import defer, task
+from twisted.web.error import Error as WebError
+import log
+import os
+
+# A mirror delivering this many bytes per second is good enough
+RACE_THRESHOLD = 256 * 1024
+# ... but only judge it after it has sent this much
+RACE_MIN_BYTES = 128 * 1024
+# When nobody is fast enough after this long, the one furthest ahead wins
+RACE_DECIDE_AFTER = 15
+RACE_INTERVAL = 0.5
+
+class Racer:
+	def __init__(self, url, filename):
+		self.url = url
+		self.filename = filename
+		self.factory = None
+		self.result = None
+
+	def watch(self, factory):
+		# Called by httpdownload.download once the transfer has started
+		self.factory = factory
+
+	def received(self):
+		if self.factory is None:
+			return 0
+		return self.factory.received
+
+	def rate(self, now):
+		if self.factory is None:
+			return 0
+		elapsed = now - self.factory.started
+		if elapsed <= 0:
+			return 0
+		return self.factory.received / elapsed
+
+	def abort(self):
+		if self.factory is not None:
+			self.factory.abort()
+
+class MirrorRace:
+	"""The Deferred fires with the factory of the winning transfer, or
+	errbacks when the winner failed (or nobody got anywhere). The winner
+	is then in self.winner, failures before the decision in self.failures."""
+	def __init__(self, threshold=RACE_THRESHOLD, minBytes=RACE_MIN_BYTES, decideAfter=RACE_DECIDE_AFTER):
+		self.threshold = threshold
+		self.minBytes = minBytes
+		self.decideAfter = decideAfter
+		self.deferred = defer.Deferred()
+		self.racers = []
+		self.winner = None
+		self.failures = []
+		self.started = None
+		self.timer = task.LoopingCall(self.check)
+
+	def add(self, url, filename):
+		racer = Racer(url, filename)
+		self.racers.append(racer)
+		return racer
+
+	def follow(self, racer, d):
+		'd is the Deferred of the racer transfer, firing with its factory'
+		d.addCallbacks(self.racerDone, self.racerFailed, callbackArgs=(racer,), errbackArgs=(racer,))
+
+	def start(self):
+		self.started = time.time()
+		self.timer.start(RACE_INTERVAL, now=False)
+
+	def stopTimer(self):
+		if self.timer.running:
+			self.timer.stop()
+
+	def check(self):
+		if self.winner is not None:
+			return
+		now = time.time()
+		for racer in self.racers:
+			if (racer.result is None) and (racer.received() >= self.minBytes) and (racer.rate(now) >= self.threshold):
+				self.decide(racer)
+				return
+		if now - self.started > self.decideAfter:
+			running = [r for r in self.racers if (r.result is None) and r.received()]
+			if running:
+				running.sort(key=lambda r: r.received())
+				self.decide(running[-1])
+
+	def decide(self, racer):
+		print>>log, "[EPGImport] Mirror race won by %s, %d bytes after %.1fs" % (racer.url, racer.received(), time.time() - self.started)
+		self.winner = racer
+		self.stopTimer()
+		for other in self.racers:
+			if other is not racer:
+				other.abort()
+				if other.result is not None:
+					self.discard(other)
+		if racer.result is not None:
+			self.fire(racer)
+
+	def fire(self, racer):
+		success, value = racer.result
+		if success:
+			self.deferred.callback(value)
+		else:
+			self.deferred.errback(value)
+
+	def discard(self, racer):
+		try:
+			os.unlink(racer.filename)
+		except:
+			pass
+
+	def racerDone(self, factory, racer):
+		racer.result = (True, factory)
+		if self.winner is None:
+			# Finished before anyone got up to speed
+			self.decide(racer)
+		elif self.winner is racer:
+			self.fire(racer)
+		else:
+			self.discard(racer)
+
+	def racerFailed(self, failure, racer):
+		racer.result = (False, failure)
+		if self.winner is None:
+			if failure.check(WebError) and (failure.value.status == '304'):
+				# Not modified, the cached copy wins
+				self.decide(racer)
+				return
+			self.failures.append((racer.url, failure))
+			self.discard(racer)
+			if len(self.failures) == len(self.racers):
+				self.stopTimer()
+				self.deferred.errback(failure)
+		elif self.winner is racer:
+			self.fire(racer)
+		else:
+			self.discard(racer)
@@ -0,0 +1,104 @@
+# Scoreboard of download mirrors.
+#
+# For every mirror host the throughput, the time to first byte and the
+# recent failures of past downloads are remembered across reboots, so
+# that the fastest healthy mirror can be tried first instead of a random
+# one.
+#
+import os
+import time
+import random
+import cPickle as pickle
+from urlparse import urlsplit
+import log
+
+SCOREBOARD_FILE = '/etc/epgimport/mirrors.pkl'
+# Weight of a new measurement in the moving averages
+SMOOTHING = 0.3
+# Failures older than this are forgiven
+FAILURE_MEMORY = 3 * 24 * 3600
+# Transfers smaller than this say little about throughput
+MIN_SAMPLE_SIZE = 64 * 1024
+
+def mirrorKey(url):
+	parts = urlsplit(url)
+	return "%s://%s" % (parts.scheme, parts.netloc.lower())
+
+def smooth(old, new):
+	if old is None:
+		return new
+	return old + SMOOTHING * (new - old)
+
+class Scoreboard:
+	def __init__(self, filename=SCOREBOARD_FILE):
+		self.filename = filename
+		try:
+			self.mirrors = pickle.load(open(filename, 'rb'))
+		except Exception, e:
+			self.mirrors = {}
+
+	def entry(self, url):
+		key = mirrorKey(url)
+		entry = self.mirrors.get(key)
+		if entry is None:
+			entry = {'throughput': None, 'ttfb': None, 'failures': []}
+			self.mirrors[key] = entry
+		return entry
+
+	def success(self, url, size, ttfb, duration):
+		entry = self.entry(url)
+		if ttfb is not None:
+			entry['ttfb'] = smooth(entry['ttfb'], ttfb)
+		if (size >= MIN_SAMPLE_SIZE) and (duration > 0):
+			entry['throughput'] = smooth(entry['throughput'], size / duration)
+		entry['failures'] = []
+		self.save()
+
+	def failure(self, url):
+		entry = self.entry(url)
+		entry['failures'].append(time.time())
+		self.save()
+
+	def failureCount(self, url):
+		entry = self.mirrors.get(mirrorKey(url))
+		if entry is None:
+			return 0
+		limit = time.time() - FAILURE_MEMORY
+		return len([t for t in entry['failures'] if t > limit])
+
+	def rank(self, urls):
+		'Returns urls ordered from most to least promising'
+		known = [e['throughput'] for e in self.mirrors.values() if e['throughput']]
+		# Unknown mirrors are assumed to be average, so they get a chance
+		if known:
+			neutral = sum(known) / len(known)
+		else:
+			neutral = 0
+		def score(url):
+			entry = self.mirrors.get(mirrorKey(url), {})
+			throughput = entry.get('throughput') or neutral
+			ttfb = entry.get('ttfb') or 0
+			# random last, so equal mirrors still share the load
+			return (self.failureCount(url), -throughput, ttfb, random.random())
+		return sorted(urls, key=score)
+
+	def choose(self, urls):
+		return self.rank(urls)[0]
+
+	def save(self):
+		try:
+			pickle.dump(self.mirrors, open(self.filename, 'wb'), pickle.HIGHEST_PROTOCOL)
+		except Exception, e:
+			print>>log, "[EPGImport] Failed to save mirror scoreboard:", e
+
+_scoreboard = None
+
+def getScoreboard():
+	global _scoreboard
+	if _scoreboard is None:
+		_scoreboard = Scoreboard()
+	return _scoreboard
+
+def choose(urls):
+	'Picks the best mirror from urls'
+	return getScoreboard().choose(urls)
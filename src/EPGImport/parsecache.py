@@ -0,0 +1,199 @@
+#
+# On-disk cache of parsed sources.
+#
+# A source file that is byte for byte the same as last time, read with the
+# same channel map and language preference, gives the same events. These
+# are kept as a stream of pickled (services, EventBuffer) batches, which
+# loads much faster than decompressing and parsing the XML again.
+#
+import os
+import time
+import cPickle as pickle
+from hashlib import sha1
+import log
+import xmltvconverter
+from eventbuffer import EventBuffer
+
+# Bump when the parsers produce different events from the same input
+CACHE_VERSION = 1
+# Parsed sources kept, the least recently used go first
+MAX_ENTRIES = 16
+MAX_BYTES = 200000000
+SUFFIX = '.events'
+BLOCK_SIZE = 65536
+# Sources are parsed for whole days around the import window, so that all
+# imports of a day, each with a window a little later, can replay them
+DAY = 86400
+
+def hashSteps(fd, digest):
+	'Feeds the content of the open file fd to digest, yields after every block'
+	while True:
+		block = fd.read(BLOCK_SIZE)
+		if not block:
+			return
+		digest.update(block)
+		yield None
+
+def fileHash(fd):
+	'Hex digest of the content of the open file fd'
+	digest = sha1()
+	for step in hashSteps(fd, digest):
+		pass
+	return digest.hexdigest()
+
+def covers(cached, window):
+	'True when events parsed for the cached window hold all of window'
+	if cached is None:
+		return True
+	if window is None:
+		return False
+	return (cached[0] <= window[0]) and (window[1] <= cached[1])
+
+def dayWindow(window):
+	'window widened to whole days, the window a source is parsed for when it is cached'
+	if window is None:
+		return None
+	earliest, latest = window
+	return (earliest // DAY * DAY, (latest // DAY + 1) * DAY)
+
+def within(events, window):
+	'The events of a batch that end at or after and start at or before window'
+	if window is None:
+		return events
+	if isinstance(events, EventBuffer):
+		return events.within(*window)
+	earliest, latest = window
+	return [event for event in events if (event[0] <= latest) and (event[0] + event[1] >= earliest)]
+
+class ParseCache:
+	def __init__(self, path):
+		self.path = path
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		self.purge()
+
+	def key(self, contentHash, channelsDict, parser):
+		digest = sha1()
+		digest.update('%d %s %s\n' % (CACHE_VERSION, parser, contentHash))
+		digest.update(repr(sorted(xmltvconverter.preferredLanguages.items())))
+		digest.update(repr(sorted(channelsDict.items())))
+		return digest.hexdigest()
+
+	def filename(self, key):
+		return os.path.join(self.path, key + SUFFIX)
+
+	def replay(self, key, window):
+		'Returns an iterator of (services, EventBuffer) for key, None when not cached'
+		filename = self.filename(key)
+		try:
+			f = open(filename, 'rb')
+			header = pickle.load(f)
+		except Exception:
+			return None
+		if not covers(header.get('window'), window):
+			f.close()
+			return None
+		try:
+			# Least recently used goes first, see purge
+			os.utime(filename, None)
+		except Exception:
+			pass
+		print>>log, "[EPGImport] Source unchanged, replaying parsed events from", filename
+		return self.load(f, window)
+
+	def load(self, f, window):
+		try:
+			while True:
+				try:
+					services, events = pickle.load(f)
+				except EOFError:
+					break
+				events = within(events, window)
+				if events:
+					yield services, events
+		finally:
+			f.close()
+
+	def record(self, key, parsed, window, batches, failed=None):
+		'''Passes on the events of batches within window, and stores all of
+		them under key once all came through. parsed is the window they were
+		parsed for, see dayWindow. failed tells afterwards whether the parser
+		gave up half way.'''
+		filename = self.filename(key)
+		temp = filename + '.tmp'
+		try:
+			f = open(temp, 'wb')
+			pickle.dump({'window': parsed, 'time': time.time()}, f, pickle.HIGHEST_PROTOCOL)
+		except Exception, e:
+			print>>log, "[EPGImport] Cannot cache parsed events:", e
+			for batch in batches:
+				if batch is not None:
+					services, events = batch
+					events = within(events, window)
+					if not events:
+						continue
+					batch = services, events
+				yield batch
+			return
+		complete = False
+		try:
+			for batch in batches:
+				if batch is not None:
+					services, events = batch
+					if f is not None:
+						try:
+							# Written before the importer strips descriptions from it
+							if isinstance(events, EventBuffer):
+								pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+							else:
+								pickle.dump((services, xmltvconverter.eventBuffer(events)), f, pickle.HIGHEST_PROTOCOL)
+						except Exception, e:
+							print>>log, "[EPGImport] Cannot cache parsed events:", e
+							f.close()
+							f = None
+					events = within(events, window)
+					if not events:
+						continue
+					batch = services, events
+				yield batch
+			complete = f is not None
+			if complete and (failed is not None) and failed():
+				print>>log, "[EPGImport] Source not parsed in full, its events are not cached"
+				complete = False
+		finally:
+			if f is not None:
+				f.close()
+			try:
+				if complete:
+					os.rename(temp, filename)
+					self.purge()
+				else:
+					os.unlink(temp)
+			except Exception, e:
+				print>>log, "[EPGImport] Cannot cache parsed events:", e
+
+	def purge(self):
+		entries = []
+		for fn in os.listdir(self.path):
+			name = os.path.join(self.path, fn)
+			if not fn.endswith(SUFFIX):
+				# Leftovers of an interrupted import
+				try:
+					os.unlink(name)
+				except Exception:
+					pass
+				continue
+			try:
+				st = os.stat(name)
+				entries.append((st.st_mtime, st.st_size, name))
+			except Exception:
+				pass
+		entries.sort(reverse=True)
+		total = 0
+		for i, (mtime, size, name) in enumerate(entries):
+			total += size
+			if (i >= MAX_ENTRIES) or (total > MAX_BYTES):
+				try:
+					os.unlink(name)
+				except Exception:
+					pass
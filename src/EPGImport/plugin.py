@@ -2,6 +2,7 @@
 from . import _
 import time
 import os
+import cPickle as pickle
 import enigma
 import log
 
@@ -84,6 +85,18 @@ config.plugins.epgimport.parse_autotimer = ConfigYesNo(default = False)
 config.plugins.epgimport.import_onlybouquet = ConfigYesNo(default = False)
 config.plugins.epgimport.import_onlyiptv = ConfigYesNo(default = False)
 config.plugins.epgimport.clear_oldepg = ConfigYesNo(default = False)
+config.plugins.epgimport.race_mirrors = ConfigSelection(default = "0", choices = [
+		("0", _("no")),
+		("2", _("2 mirrors")),
+		("3", _("3 mirrors"))
+		])
+config.plugins.epgimport.parse_workers = ConfigSelection(default = "1", choices = [
+		("1", _("no")),
+		("2", _("2 processes")),
+		("4", _("4 processes"))
+		])
+# lang attributes of XMLTV titles and descriptions, best first
+config.plugins.epgimport.preferred_languages = ConfigText(default = "nl", fixed_size = False)
 config.plugins.epgimport.day_profile = ConfigSelection(choices = [("1", _("Press OK"))], default = "1")
 config.plugins.extra_epgimport = ConfigSubsection()
 config.plugins.extra_epgimport.last_import = ConfigText(default = "none")
@@ -109,6 +122,7 @@ weekdays = [
 # Plugin
 import EPGImport
 import EPGConfig
+import xmltvconverter
 
 # Plugin definition
 from Plugins.Plugin import PluginDescriptor
@@ -192,7 +206,8 @@ def getBouquetChannelList():
 	return channels
 
 # Filter servicerefs that this box can display by starting a fake recording.
-def channelFilter(ref):
+# Returns None when the answer may be different next time.
+def checkChannel(ref):
 	if not ref:
 		return False
 	# ignore non IPTV
@@ -245,14 +260,111 @@ def channelFilter(ref):
 			r = fakeRecResult in (0, -7)
 			#if not r:
 			#	print>>log, "Rejected (%d): %s" % (fakeRecResult, ref) 			
-			return r
+			if r:
+				return True
+			# The tuners may just be busy recording, so ask again next time
+			if NavigationInstance.instance.getRecordings():
+				return None
+			return False
 #	print>>log, "Invalid serviceref string:", ref
 	return False
 
+SERVICES_PATH = '/etc/enigma2'
+
+def fileStamps(names):
+	stamps = []
+	for name in names:
+		try:
+			st = os.stat(os.path.join(SERVICES_PATH, name))
+			stamps.append((name, st.st_mtime, st.st_size))
+		except OSError:
+			pass
+	return stamps
+
+def channelFilterKey():
+	'Stands for everything the verdicts of channelFilter depend on, see EPGConfig.EPGChannel.read'
+	names = ['lamedb', 'lamedb5']
+	if config.plugins.epgimport.import_onlybouquet.value:
+		try:
+			names += sorted([fn for fn in os.listdir(SERVICES_PATH) if fn.startswith(('bouquets.', 'userbouquet.', 'alternatives.'))])
+		except OSError:
+			pass
+	return repr((config.plugins.epgimport.import_onlyiptv.value,
+		config.plugins.epgimport.import_onlybouquet.value,
+		config.usage.multibouquet.value,
+		sorted(filtersServices.filtersServicesList.servicesList()),
+		fileStamps(names),
+		tunerConfiguration()))
+
+def tunerConfiguration():
+	try:
+		return config.Nims.saved_value
+	except Exception:
+		return None
+
+# Verdicts of checkChannel per service reference, kept between imports
+# for as long as the channelFilterKey stays the same
+FILTER_VERDICTS = os.path.join(SERVICES_PATH, 'epgimport.verdicts')
+filterVerdicts = None
+filterVerdictsKey = None
+filterVerdictsChanged = False
+
+def loadFilterVerdicts(key):
+	global filterVerdicts, filterVerdictsKey, filterVerdictsChanged
+	if (filterVerdicts is not None) and (filterVerdictsKey == key):
+		return
+	filterVerdicts = {}
+	filterVerdictsKey = key
+	filterVerdictsChanged = False
+	try:
+		saved = pickle.load(open(FILTER_VERDICTS, 'rb'))
+	except Exception:
+		return
+	if saved.get('key') == key:
+		filterVerdicts = saved['verdicts']
+		print>>log, "[XMLTVImport] %d channel filter verdicts still valid" % len(filterVerdicts)
+	else:
+		print>>log, "[XMLTVImport] Services, bouquets or settings changed, checking channels again"
+
+def saveFilterVerdicts():
+	global filterVerdictsChanged
+	if not filterVerdictsChanged:
+		return
+	try:
+		pickle.dump({'key': filterVerdictsKey, 'verdicts': filterVerdicts}, open(FILTER_VERDICTS, 'wb'), pickle.HIGHEST_PROTOCOL)
+		filterVerdictsChanged = False
+	except Exception, e:
+		print>>log, "[XMLTVImport] Cannot save channel filter verdicts:", e
+
+def channelFilter(ref):
+	'''checkChannel, remembered per service reference. None rejects ref for
+	now only, it is asked again next time, see EPGConfig.EPGChannel.parse'''
+	global filterVerdictsChanged
+	if filterVerdicts is None:
+		return checkChannel(ref)
+	verdict = filterVerdicts.get(ref)
+	if verdict is None:
+		verdict = checkChannel(ref)
+		if verdict is None:
+			return None
+		filterVerdicts[ref] = verdict
+		filterVerdictsChanged = True
+	return verdict
+
 epgimport = EPGImport.EPGImport(enigma.eEPGCache.getInstance(), channelFilter)
 
 lastImportResult = None
 
+def importWindow():
+	'(earliest stop, latest start) of what the EPG cache keeps, None when unknown'
+	try:
+		outdated = int(config.misc.epgcache_outdated_timespan.value)
+		timespan = int(config.misc.epgcache_timespan.value)
+	except Exception:
+		return None
+	now = int(time.time())
+	return (now - outdated * 3600, now + timespan * 86400)
+
 def startImport():
 	EPGImport.HDD_EPG_DAT = config.misc.epgcache_filename.value
 	if config.plugins.epgimport.clear_oldepg.value and hasattr(epgimport.epgcache, 'flushEPG'):
@@ -260,7 +372,12 @@ def startImport():
 		EPGImport.unlink_if_exists(EPGImport.HDD_EPG_DAT + '.backup')
 		epgimport.epgcache.flushEPG()
 	epgimport.onDone = doneImport
-	epgimport.beginImport(longDescUntil = config.plugins.epgimport.longDescDays.value * 24 * 3600 + time.time())
+	epgimport.raceMirrors = int(config.plugins.epgimport.race_mirrors.value)
+	epgimport.parseWorkers = int(config.plugins.epgimport.parse_workers.value)
+	epgimport.channelFilterKey = channelFilterKey()
+	loadFilterVerdicts(epgimport.channelFilterKey)
+	xmltvconverter.setPreferredLanguages(config.plugins.epgimport.preferred_languages.value)
+	epgimport.beginImport(longDescUntil = config.plugins.epgimport.longDescDays.value * 24 * 3600 + time.time(), window = importWindow())
 
 
 FHD = False
@@ -392,6 +509,9 @@ class EPGImportConfig(ConfigListScreen,Screen):
 		self.cfg_longDescDays = getConfigListEntry(_("Load long descriptions up to X days"), self.EPG.longDescDays)
 		self.cfg_parse_autotimer = getConfigListEntry(_("Run AutoTimer after import"), self.EPG.parse_autotimer)
 		self.cfg_clear_oldepg = getConfigListEntry(_("Clearing current EPG before import"), config.plugins.epgimport.clear_oldepg)
+		self.cfg_race_mirrors = getConfigListEntry(_("Download sources from several mirrors at once"), self.EPG.race_mirrors)
+		self.cfg_parse_workers = getConfigListEntry(_("Parse big files on several cores"), self.EPG.parse_workers)
+		self.cfg_preferred_languages = getConfigListEntry(_("Preferred languages (e.g. nl,en)"), self.EPG.preferred_languages)
 
 	def createSetup(self):
 		list = [ self.cfg_enabled ]
@@ -418,6 +538,9 @@ class EPGImportConfig(ConfigListScreen,Screen):
 		if hasattr(enigma.eEPGCache, 'flushEPG'):
 			list.append(self.cfg_clear_oldepg)
 		list.append(self.cfg_longDescDays)
+		list.append(self.cfg_race_mirrors)
+		list.append(self.cfg_parse_workers)
+		list.append(self.cfg_preferred_languages)
 		if fileExists("/usr/lib/enigma2/python/Plugins/Extensions/AutoTimer/plugin.py"):
 			try:
 				from Plugins.Extensions.AutoTimer.AutoTimer import AutoTimer
@@ -473,7 +596,10 @@ class EPGImportConfig(ConfigListScreen,Screen):
 		text = ""
 		if epgimport.isImportRunning():
 			src = epgimport.source
-			text = self.importStatusTemplate % (src.description, epgimport.eventCount)
+			if src is None:
+				text = _("Checking servers...")
+			else:
+				text = self.importStatusTemplate % (src.description, epgimport.eventCount)
 		self["status"].setText(text)
 		if lastImportResult and (lastImportResult != self.lastImportResult):
 			start, count = lastImportResult
@@ -487,7 +613,10 @@ class EPGImportConfig(ConfigListScreen,Screen):
 
 	def keyInfo(self):
 		last_import = config.plugins.extra_epgimport.last_import.value
-		self.session.open(MessageBox,_("Last import: %s events") % (last_import),type=MessageBox.TYPE_INFO)
+		text = _("Last import: %s events") % (last_import)
+		if epgimport.differences is not None:
+			text += "\n" + _("%d new, %d changed, %d removed, %d unchanged") % epgimport.differences
+		self.session.open(MessageBox,text,type=MessageBox.TYPE_INFO)
 
 	def doimport(self, one_source=None):
 		if epgimport.isImportRunning():
@@ -838,6 +967,7 @@ def doneImport(reboot=False, epgfile=None):
 	global _session, lastImportResult, BouquetChannelListList, serviceIgnoreList
 	BouquetChannelListList = None
 	serviceIgnoreList = None
+	saveFilterVerdicts()
 	lastImportResult = (time.time(), epgimport.eventCount)
 	try:
 		start, count = lastImportResult
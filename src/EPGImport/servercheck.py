@@ -0,0 +1,114 @@
+# Server validation.
+#
+# Rytec style mirrors publish a LastUpdate.txt with the date of their
+# last update next to the source files. A mirror whose date is too old
+# is skipped. The check runs in the reactor without blocking, for all
+# mirrors at once, and its results are kept on disk for a while.
+#
+import os
+import time
+import cPickle as pickle
+from datetime import datetime
+from twisted.internet import defer
+from twisted.web.client import getPage
+import log
+
+CHECK_FILE = "LastUpdate.txt"
+DATE_FORMAT = "%Y-%m-%d"
+# Maximum age of the mirror contents in days
+ALLOWED_DELTA = 2
+STATUS_FILE = '/etc/epgimport/serverstatus.pkl'
+# Seconds a result stays valid, rejections are checked again sooner
+VALID_TTL = 6 * 3600
+REJECTED_TTL = 3600
+CHECK_TIMEOUT = 10
+
+def serverOf(url):
+	return os.path.split(url)[0]
+
+class ServerValidator:
+	def __init__(self, filename=STATUS_FILE):
+		self.filename = filename
+		self.pending = {}
+		try:
+			self.status = pickle.load(open(filename, 'rb'))
+		except Exception, e:
+			self.status = {}
+
+	def cached(self, server):
+		'Returns the stored verdict for server if still fresh, else None'
+		entry = self.status.get(server)
+		if entry is None:
+			return None
+		valid, checked = entry
+		if valid:
+			ttl = VALID_TTL
+		else:
+			ttl = REJECTED_TTL
+		if checked + ttl < time.time():
+			return None
+		return valid
+
+	def check(self, url):
+		'Returns a Deferred that fires with True when the server of url is acceptable'
+		server = serverOf(url)
+		valid = self.cached(server)
+		if valid is not None:
+			return defer.succeed(valid)
+		d = defer.Deferred()
+		if server in self.pending:
+			self.pending[server].append(d)
+			return d
+		# Before getPage, its result may already be there when it returns
+		self.pending[server] = [d]
+		try:
+			page = getPage((server + "/" + CHECK_FILE).encode('utf-8'), agent='Twisted Client', timeout=CHECK_TIMEOUT)
+		except Exception, e:
+			print>>log, "[EPGImport] checkValidServer cannot check server %s:" % server, e
+			for waiter in self.pending.pop(server, []):
+				waiter.errback(e)
+			return d
+		page.addCallbacks(self.gotCheckFile, self.checkFailed, callbackArgs=(server,), errbackArgs=(server,))
+		page.addCallback(self.store, server)
+		return d
+
+	def gotCheckFile(self, data, server):
+		try:
+			fileDate = datetime.strptime(data.strip(), DATE_FORMAT)
+		except ValueError:
+			print>>log, "[EPGImport] checkValidServer wrong date format in file rejecting server %s" % server
+			return False
+		if (datetime.now() - fileDate).days <= ALLOWED_DELTA:
+			return True
+		print>>log, "[EPGImport] checkValidServer rejected server delta days too high: %s" % server
+		return False
+
+	def checkFailed(self, failure, server):
+		print>>log, "[EPGImport] checkValidServer rejected server download error for: %s (%s)" % (server, failure.getErrorMessage())
+		return False
+
+	def store(self, valid, server):
+		self.status[server] = (valid, time.time())
+		self.save()
+		for d in self.pending.pop(server, []):
+			d.callback(valid)
+
+	def checkAll(self, urls):
+		'Checks all urls concurrently, the Deferred fires with a dict url -> valid'
+		urls = list(urls)
+		dl = defer.gatherResults([self.check(url) for url in urls])
+		return dl.addCallback(lambda results: dict(zip(urls, results)))
+
+	def save(self):
+		try:
+			pickle.dump(self.status, open(self.filename, 'wb'), pickle.HIGHEST_PROTOCOL)
+		except Exception, e:
+			print>>log, "[EPGImport] Failed to save server status:", e
+
+_validator = None
+
+def getValidator():
+	global _validator
+	if _validator is None:
+		_validator = ServerValidator()
+	return _validator
@@ -0,0 +1,393 @@
+#
+# Parsing of very large XMLTV files on several cores.
+#
+# The programme stream is cut into chunks at <programme> boundaries, each
+# chunk becomes a small XMLTV document of its own. Worker processes run
+# the normal parser on the chunks, the events of a chunk are grouped per
+# channel and come back in the order of the chunks.
+#
+# The workers are fresh Python interpreters that only load the parser
+# (see serve), started like the decompressors of compression.py. Forking
+# enigma2 itself would copy whatever locks its other threads hold.
+#
+import os
+import sys
+import threading
+import subprocess
+import Queue
+import cPickle as pickle
+import log
+import xmltvconverter
+from collections import deque
+from cStringIO import StringIO
+from xmltvconverter import BATCH_EVENTS, eventBuffer
+
+# Size of one chunk of programmes handed to a worker
+CHUNK_SIZE = 4 * 1024 * 1024
+# Reads from the (decompressed) source
+BLOCK_SIZE = 65536
+# Parsed chunks waiting to be imported, per worker
+CHUNKS_AHEAD = 2
+
+PROGRAMME = '<programme'
+ROOT_END = '</tv>'
+
+# Run serve() in a worker interpreter started in this directory
+WORKER_COMMAND = 'import sharding; sharding.serve()'
+PYTHON_NAMES = ('python2', 'python')
+
+def cpuCount():
+	try:
+		return max(os.sysconf('SC_NPROCESSORS_ONLN'), 1)
+	except Exception:
+		return 1
+
+def findPython():
+	'Command line of a Python interpreter for the workers, None if there is none'
+	executable = sys.executable
+	if not (executable and os.path.basename(executable).startswith('python')):
+		# Inside enigma2 this is the enigma2 binary, or nothing
+		executable = None
+		for path in os.environ.get('PATH', '/bin:/usr/bin').split(os.pathsep):
+			for name in PYTHON_NAMES:
+				if os.access(os.path.join(path, name), os.X_OK):
+					executable = os.path.join(path, name)
+					break
+			if executable is not None:
+				break
+	if executable is None:
+		return None
+	here = os.path.dirname(os.path.abspath(__file__))
+	if not os.path.exists(os.path.join(here, 'sharding.py')):
+		# Installed as optimized bytecode only
+		return (executable, '-O', '-c', WORKER_COMMAND)
+	return (executable, '-c', WORKER_COMMAND)
+
+def declaration(header):
+	'The <?xml ...?> declaration of header, so that every chunk keeps the encoding'
+	header = header.lstrip()
+	if header.startswith('<?xml'):
+		end = header.find('?>')
+		if end > 0:
+			return header[:end + 2] + '\n'
+	return ''
+
+def splitProgrammes(fd, chunkSize=CHUNK_SIZE):
+	'Yields XMLTV documents of about chunkSize bytes holding the whole <programme> elements of fd'
+	parts = []
+	size = 0
+	prolog = None
+	while True:
+		block = fd.read(BLOCK_SIZE)
+		if block:
+			parts.append(block)
+			size += len(block)
+			if size < chunkSize:
+				continue
+		data = ''.join(parts)
+		if prolog is None:
+			start = data.find(PROGRAMME)
+			if start < 0:
+				if not block:
+					return
+				# Still in the channel list
+				parts = [data]
+				size = 0
+				continue
+			prolog = declaration(data[:start])
+			data = data[start:]
+		if block:
+			cut = data.rfind(PROGRAMME)
+			if cut <= 0:
+				# A single programme larger than a chunk, read on
+				parts = [data]
+				size = 0
+				continue
+			chunk, data = data[:cut], data[cut:]
+		else:
+			end = data.rfind(ROOT_END)
+			if end >= 0:
+				chunk = data[:end]
+			else:
+				chunk = data
+		yield prolog + '<tv>' + chunk + ROOT_END
+		if not block:
+			return
+		parts = [data]
+		size = len(data)
+
+def groupEvents(parser, document, channelsDict):
+	"""Parses one chunk, returns ([(services, [event, ...]), ...] in order of
+	first appearance, programmes outside the window, {channel: programmes
+	skipped}). The skipped programmes are not logged, see Skipped."""
+	groups = {}
+	result = []
+	parser.quiet = True
+	for item in parser.iterator(StringIO(document), channelsDict):
+		if item is None:
+			continue
+		services, event = item
+		key = tuple(services)
+		events = groups.get(key)
+		if events is None:
+			events = groups[key] = []
+			result.append((services, events))
+		events.append(event)
+	if getattr(parser, 'failed', False):
+		raise IOError, "Chunk not parsed in full"
+	converter = parser.converter
+	if converter is None:
+		return [], 0, {}
+	return result, converter.outOfWindow, converter.unknownChannels
+
+class Skipped:
+	'Adds up the programmes skipped in all chunks, to log them once'
+	def __init__(self):
+		self.outOfWindow = 0
+		self.unknownChannels = {}
+
+	def add(self, outOfWindow, unknownChannels):
+		self.outOfWindow += outOfWindow
+		for channel, count in unknownChannels.iteritems():
+			self.unknownChannels[channel] = self.unknownChannels.get(channel, 0) + count
+
+	def log(self):
+		xmltvconverter.logSkipped(self.outOfWindow, self.unknownChannels)
+
+def serve():
+	'Main loop of a worker process: parses the chunks arriving on stdin'
+	stdin = sys.stdin
+	stdout = sys.stdout
+	# stdout carries the results, anything printed goes to stderr
+	sys.stdout = sys.stderr
+	settings = pickle.load(stdin)
+	xmltvconverter.preferredLanguages = settings['languages']
+	xmltvconverter.setImportWindow(settings['window'])
+	parser = __import__(settings['parser']).new()
+	channelsDict = settings['channels']
+	while True:
+		try:
+			document = pickle.load(stdin)
+		except EOFError:
+			return
+		try:
+			groups, outOfWindow, unknownChannels = groupEvents(parser, document, channelsDict)
+			# Much less to pickle, titles and languages repeat a lot
+			groups = [(services, eventBuffer(events)) for services, events in groups]
+			result = (True, groups, outOfWindow, unknownChannels)
+		except Exception, e:
+			result = (False, str(e))
+		pickle.dump(result, stdout, pickle.HIGHEST_PROTOCOL)
+		stdout.flush()
+
+class Worker:
+	'A worker process, chunks are written and results read by threads of their own'
+	def __init__(self, args, settings):
+		self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+			cwd=os.path.dirname(os.path.abspath(__file__)), close_fds=True)
+		self.inbox = Queue.Queue()
+		self.results = Queue.Queue()
+		self.inbox.put(settings)
+		self.threads = []
+		for target in (self.write, self.read):
+			thread = threading.Thread(target=target)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def write(self):
+		# A thread of its own, so that a full pipe never stops the reading
+		stdin = self.proc.stdin
+		try:
+			while True:
+				message = self.inbox.get()
+				if message is None:
+					break
+				pickle.dump(message, stdin, pickle.HIGHEST_PROTOCOL)
+				stdin.flush()
+		except Exception:
+			pass
+		try:
+			stdin.close()
+		except Exception:
+			pass
+
+	def read(self):
+		while True:
+			try:
+				result = pickle.load(self.proc.stdout)
+			except Exception, e:
+				self.results.put((False, "worker process ended: %s" % e))
+				return
+			self.results.put(result)
+
+	def parse(self, document):
+		self.inbox.put(document)
+
+	def ready(self):
+		return not self.results.empty()
+
+	def result(self):
+		'The next result, (groups, outOfWindow, unknownChannels)'
+		result = self.results.get()
+		if not result[0]:
+			raise IOError, "Parser process failed: %s" % result[1]
+		return result[1:]
+
+	def close(self):
+		self.inbox.put(None)
+		self.proc.wait()
+		for thread in self.threads:
+			thread.join()
+
+	def terminate(self):
+		if self.proc.poll() is None:
+			try:
+				self.proc.kill()
+			except OSError:
+				pass
+		self.close()
+
+def startWorkers(workers, parser, channelsDict):
+	args = findPython()
+	if args is None:
+		print>>log, "[EPGImport] No python interpreter for parser processes, parsing in one"
+		return None
+	settings = {
+		'parser': parser.__class__.__module__.split('.')[-1],
+		'channels': channelsDict,
+		'languages': xmltvconverter.preferredLanguages,
+		'window': xmltvconverter.importWindow,
+	}
+	pool = []
+	try:
+		for i in xrange(workers):
+			pool.append(Worker(args, settings))
+	except Exception, e:
+		print>>log, "[EPGImport] Cannot start parser processes, parsing in one:", e
+		for worker in pool:
+			worker.terminate()
+		return None
+	return pool
+
+def batches(groups, maxEvents):
+	for services, events in groups:
+		if len(events) <= maxEvents:
+			yield services, events
+			continue
+		for i in xrange(0, len(events), maxEvents):
+			if isinstance(events, list):
+				yield services, events[i:i + maxEvents]
+			else:
+				yield services, events.part(i, i + maxEvents)
+
+def shardedBatches(fd, parser, channelsDict, workers, wait=True, chunkSize=CHUNK_SIZE, maxEvents=BATCH_EVENTS):
+	'''Same events as parser.batches(fd, channelsDict), parsed by worker
+	processes. Within a chunk the events come grouped per channel.
+	When wait is False, None is yielded while the next chunk is not parsed
+	yet, so that a reactor is not blocked.'''
+	chunks = splitProgrammes(fd, chunkSize)
+	first = next(chunks, None)
+	if first is None:
+		return
+	second = next(chunks, None)
+	skipped = Skipped()
+	pool = None
+	if second is not None and workers > 1:
+		pool = startWorkers(workers, parser, channelsDict)
+	if pool is None:
+		for document in (first, second):
+			if document is not None:
+				groups, outOfWindow, unknownChannels = groupEvents(parser, document, channelsDict)
+				skipped.add(outOfWindow, unknownChannels)
+				for batch in batches(groups, maxEvents):
+					yield batch
+		for document in chunks:
+			groups, outOfWindow, unknownChannels = groupEvents(parser, document, channelsDict)
+			skipped.add(outOfWindow, unknownChannels)
+			for batch in batches(groups, maxEvents):
+				yield batch
+		skipped.log()
+		return
+	print>>log, "[EPGImport] Parsing in %d processes" % workers
+	# The workers the chunks went to, in the order of the chunks
+	pending = deque()
+	submitted = [0]
+	def submit(document):
+		worker = pool[submitted[0] % len(pool)]
+		submitted[0] += 1
+		worker.parse(document)
+		pending.append(worker)
+	finished = False
+	try:
+		submit(first)
+		submit(second)
+		while pending:
+			for document in chunks:
+				submit(document)
+				if len(pending) >= workers * CHUNKS_AHEAD:
+					break
+			worker = pending.popleft()
+			if not wait:
+				while not worker.ready():
+					yield None
+			groups, outOfWindow, unknownChannels = worker.result()
+			skipped.add(outOfWindow, unknownChannels)
+			for batch in batches(groups, maxEvents):
+				yield batch
+		finished = True
+	finally:
+		for worker in pool:
+			if finished:
+				worker.close()
+			else:
+				worker.terminate()
+	skipped.log()
+
+if __name__ == '__main__':
+	# Parse time of a big file in 1 to N processes.
+	# Usage: python sharding.py [file.xml[.gz|.xz|...]] [workers]
+	import time
+	import tempfile
+	import compression
+	import gen_xmltv
+	filename = None
+	if len(sys.argv) > 1:
+		filename = sys.argv[1]
+	else:
+		fd, filename = tempfile.mkstemp(suffix='.xml')
+		f = os.fdopen(fd, 'wb')
+		f.write('<?xml version="1.0" encoding="UTF-8"?>\n<tv>\n')
+		for i in xrange(100):
+			f.write('<channel id="Channel%d.nl"><display-name>Channel %d</display-name></channel>\n' % (i, i))
+		for i in xrange(300000):
+			f.write('<programme start="2024%02d%02d%02d%02d00 +0100" stop="2024%02d%02d%02d%02d00 +0100" channel="Channel%d.nl">'
+				'<title lang="nl">Titel %d</title><sub-title lang="nl">Aflevering %d</sub-title>'
+				'<desc lang="nl">Beschrijving van programma %d, wat langer zodat het op echte gegevens lijkt.</desc>'
+				'<category lang="en">News</category></programme>\n' %
+				(i % 12 + 1, i % 28 + 1, i % 24, i % 30, i % 12 + 1, i % 28 + 1, i % 24, i % 30 + 30, i % 100, i, i, i))
+		f.write('</tv>\n')
+		f.close()
+	# Some channels unmapped, their skipped programmes are logged once
+	channels = dict([('channel%d.nl' % i, ['1:0:1:%X:1:1:0:0:0:0:' % (i + 1)]) for i in xrange(90)])
+	if len(sys.argv) > 2:
+		most = int(sys.argv[2])
+	else:
+		most = max(cpuCount(), 2)
+	print "File: %s, %d bytes, %d cpus" % (filename, os.path.getsize(filename), cpuCount())
+	parser = gen_xmltv.new()
+	start = time.time()
+	expected = sorted(e for e in parser.iterator(compression.openFile(filename), channels) if e is not None)
+	single = time.time() - start
+	print "  unsharded  %6.2fs %7d events" % (single, len(expected))
+	workers = 1
+	while workers <= most:
+		start = time.time()
+		events = []
+		for services, batch in shardedBatches(compression.openFile(filename), parser, channels, workers):
+			events.extend([(services, e) for e in batch])
+		elapsed = time.time() - start
+		print "  %2d workers %6.2fs %7d events, speedup %.2fx, same events: %s" % (workers, elapsed, len(events), single / elapsed, sorted(events) == expected)
+		workers *= 2
+	if len(sys.argv) <= 1:
+		os.unlink(filename)
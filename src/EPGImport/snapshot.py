@@ -0,0 +1,201 @@
+#
+# Fingerprints of the previous import, for incremental imports.
+#
+# Per service, every event is kept as its start, its duration and a hash
+# of its texts. Comparing the events of this import with the previous
+# fingerprints tells which events are new, which changed and which are
+# gone. Storage that keeps its data between imports (epg.db) only has to
+# write those, see epgdb.py.
+#
+import os
+import time
+import zlib
+import cPickle as pickle
+from array import array
+from itertools import izip
+import log
+from eventbuffer import EventBuffer
+
+# Bump when the fingerprint of an event changes
+SNAPSHOT_VERSION = 1
+
+def eventHash(title, subtitle, description, category, language):
+	return zlib.crc32('%s\0%s\0%s\0%d\0%s' % (title, subtitle, description, category, language))
+
+class Fingerprints:
+	'start, duration and text hash of the events of one services'
+	def __init__(self):
+		self.start = array('I')
+		self.duration = array('i')
+		self.hash = array('i')
+
+	def add(self, events):
+		starts = self.start.append
+		durations = self.duration.append
+		hashes = self.hash.append
+		if isinstance(events, EventBuffer):
+			strings = events.strings.strings
+			for start, duration, title, subtitle, description, category, language in izip(events.start,
+					events.duration, events.title, events.subtitle, events.description, events.category, events.language):
+				starts(start)
+				durations(duration)
+				hashes(eventHash(strings[title], strings[subtitle], strings[description], category, strings[language]))
+		else:
+			for start, duration, title, subtitle, description, category, language in events:
+				start = int(start)
+				starts((start > 0) and start or 0)
+				durations(int(duration))
+				hashes(eventHash(title, subtitle, description, category, language))
+
+	def __len__(self):
+		return len(self.start)
+
+	def __getstate__(self):
+		return (self.start.tostring(), self.duration.tostring(), self.hash.tostring())
+
+	def __setstate__(self, state):
+		self.__init__()
+		for column, data in izip((self.start, self.duration, self.hash), state):
+			column.fromstring(data)
+
+class Delta:
+	'''The difference between the previous and the current events of services.
+	changed lists the rows of the current events that are new or changed,
+	kept the rows of the events that are the same as before.'''
+	def __init__(self):
+		self.changed = []
+		self.kept = []
+		# starts of the previous events that are gone
+		self.removed = []
+		self.inserted = 0
+		self.expired = 0
+
+def compare(previous, current, earliest=None):
+	'''Delta between the Fingerprints previous and current. Previous events
+	that ended before earliest expired, they are not counted as removed.
+	Returns None when a start is not unique, an event cannot be told apart then.'''
+	before = {}
+	if previous is not None:
+		for event in izip(previous.start, previous.duration, previous.hash):
+			before[event[0]] = event
+		if len(before) != len(previous):
+			return None
+	delta = Delta()
+	seen = set()
+	row = 0
+	for event in izip(current.start, current.duration, current.hash):
+		start = event[0]
+		if start in seen:
+			return None
+		seen.add(start)
+		old = before.pop(start, None)
+		if old == event:
+			delta.kept.append(row)
+		else:
+			if old is None:
+				delta.inserted += 1
+			delta.changed.append(row)
+		row += 1
+	for start, duration, hash in before.itervalues():
+		if (earliest is not None) and (start + duration < earliest):
+			delta.expired += 1
+		else:
+			delta.removed.append(start)
+	return delta
+
+class Snapshot:
+	'''The fingerprints of the previous imports and of the running one, per
+	services. Only the services marked as written replace their previous
+	fingerprints, the other services keep them.'''
+	def __init__(self, filename, earliest=None):
+		self.filename = filename
+		self.earliest = earliest
+		self.previous = self.load()
+		self.current = {}
+		# keys of current that made it into the storage
+		self.stored = set()
+
+	def load(self):
+		try:
+			f = open(self.filename, 'rb')
+		except IOError:
+			return {}
+		try:
+			try:
+				header = pickle.load(f)
+				if header.get('version') != SNAPSHOT_VERSION:
+					return {}
+				return pickle.load(f)
+			except Exception, e:
+				print>>log, "[EPGImport] Cannot read import snapshot:", e
+				return {}
+		finally:
+			f.close()
+
+	def add(self, services, events):
+		key = tuple(services)
+		fingerprints = self.current.get(key)
+		if fingerprints is None:
+			fingerprints = self.current[key] = Fingerprints()
+		fingerprints.add(events)
+
+	def written(self, services):
+		'The events added for services are in the storage now'
+		self.stored.add(tuple(services))
+
+	def delta(self, services):
+		'Delta of the events added for services, None when nothing can be said'
+		key = tuple(services)
+		current = self.current.get(key)
+		if current is None:
+			return None
+		return compare(self.previous.get(key), current, self.earliest)
+
+	def summary(self):
+		'(inserted, changed, removed, unchanged) events over all services, None without a previous import'
+		if not self.previous:
+			return None
+		inserted = changed = removed = unchanged = 0
+		# Services this import did not write may come from another source
+		for key in self.stored:
+			current = self.current[key]
+			delta = compare(self.previous.get(key), current, self.earliest)
+			if delta is None:
+				# All new, as far as anyone can tell
+				inserted += len(current)
+				continue
+			inserted += delta.inserted
+			changed += len(delta.changed) - delta.inserted
+			removed += len(delta.removed)
+			unchanged += len(delta.kept)
+		return inserted, changed, removed, unchanged
+
+	def merged(self):
+		'The previous fingerprints that still matter, updated with the written ones'
+		earliest = self.earliest
+		result = {}
+		for key, previous in self.previous.iteritems():
+			# Services no source gave for a while expire
+			if (earliest is None) or any(start + duration >= earliest for start, duration in izip(previous.start, previous.duration)):
+				result[key] = previous
+		for key in self.stored:
+			result[key] = self.current[key]
+		return result
+
+	def save(self):
+		'Keeps the fingerprints of this import for the next one'
+		temp = self.filename + '.tmp'
+		try:
+			f = open(temp, 'wb')
+			try:
+				pickle.dump({'version': SNAPSHOT_VERSION, 'time': time.time()}, f, pickle.HIGHEST_PROTOCOL)
+				pickle.dump(self.merged(), f, pickle.HIGHEST_PROTOCOL)
+			finally:
+				f.close()
+			os.rename(temp, self.filename)
+		except Exception, e:
+			print>>log, "[EPGImport] Cannot save import snapshot:", e
+			try:
+				os.unlink(temp)
+			except Exception:
+				pass
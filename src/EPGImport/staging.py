@@ -0,0 +1,130 @@
+# Where downloads are staged.
+#
+# The mount table is kept in memory and only read again when the kernel
+# reports a change of /proc/mounts. Space that running transfers are
+# going to need is booked against their file system, so that several
+# downloads at once do not all pick the same nearly full RAM disk.
+#
+import os
+import select
+import log
+
+MOUNTS_FILE = '/proc/mounts'
+# RAM is tried first, disks when the file would not fit
+RAM_LOCATIONS = ('/tmp',)
+DISK_LOCATIONS = ('/media/DOMExtender', '/media/cf', '/media/mmc', '/media/usb', '/media/hdd')
+DEFAULT_LOCATION = '/tmp'
+# Left free in RAM no matter what
+RAM_RESERVE = 50000000
+# Assumed size of a download when the server does not tell
+UNKNOWN_SIZE = 9000000
+
+class MountTable:
+	'The mount points listed in /proc/mounts, read again only after a change'
+	def __init__(self, filename=MOUNTS_FILE):
+		self.filename = filename
+		self.fd = None
+		self.poller = None
+		self.mountpoints = None
+
+	def changed(self):
+		if (self.mountpoints is None) or (self.poller is None):
+			return True
+		try:
+			# The kernel flags the file when something was (un)mounted
+			return bool(self.poller.poll(0))
+		except Exception:
+			return True
+
+	def read(self):
+		try:
+			if self.fd is None:
+				self.fd = open(self.filename, 'rb')
+				try:
+					self.poller = select.poll()
+					self.poller.register(self.fd.fileno(), select.POLLERR | select.POLLPRI)
+				except Exception:
+					self.poller = None
+			self.fd.seek(0)
+			lines = self.fd.readlines()
+		except Exception, e:
+			print>>log, "[EPGImport] Failed to read mounts:", e
+			self.close()
+			self.mountpoints = set()
+			return
+		# format: device mountpoint fstype options #
+		self.mountpoints = set([x.split(' ', 2)[1] for x in lines if ' ' in x])
+
+	def get(self):
+		if self.changed():
+			self.read()
+		return self.mountpoints
+
+	def close(self):
+		if self.fd is not None:
+			self.fd.close()
+		self.fd = None
+		self.poller = None
+
+class StorageManager:
+	def __init__(self):
+		self.mounts = MountTable()
+		# filename: (device, size)
+		self.reserved = {}
+
+	def isMounted(self, path):
+		return path in self.mounts.get()
+
+	def free(self, path):
+		'Free bytes on the file system of path, minus what is booked there'
+		try:
+			diskstat = os.statvfs(path)
+			device = os.stat(path).st_dev
+		except Exception, e:
+			print>>log, "[EPGImport] Failed to stat %s:" % path, e
+			return 0
+		free = diskstat.f_bfree * diskstat.f_bsize
+		for dev, size in self.reserved.values():
+			if dev == device:
+				free -= size
+		return free
+
+	def mounted(self, minFree, *candidates):
+		'Returns the first mounted candidate with more than minFree bytes, or None'
+		for candidate in candidates:
+			if self.isMounted(candidate) and (self.free(candidate) > minFree):
+				return candidate
+		return None
+
+	def locate(self, size=None):
+		'Picks the directory for a download of size bytes, None when unknown'
+		if size is None:
+			size = UNKNOWN_SIZE
+		for path in RAM_LOCATIONS:
+			if self.free(path) - size > RAM_RESERVE:
+				return path
+		path = self.mounted(size, *DISK_LOCATIONS)
+		if path is None:
+			print>>log, "[EPGImport] No room for %d bytes anywhere, trying %s" % (size, DEFAULT_LOCATION)
+			return DEFAULT_LOCATION
+		return path
+
+	def reserve(self, filename, size=None):
+		'Books size bytes for filename until release() is called'
+		if size is None:
+			size = UNKNOWN_SIZE
+		try:
+			self.reserved[filename] = (os.stat(os.path.dirname(filename)).st_dev, size)
+		except Exception, e:
+			print>>log, "[EPGImport] Cannot reserve space for %s:" % filename, e
+
+	def release(self, filename):
+		self.reserved.pop(filename, None)
+
+_manager = None
+
+def getManager():
+	global _manager
+	if _manager is None:
+		_manager = StorageManager()
+	return _manager
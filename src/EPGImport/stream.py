@@ -0,0 +1,131 @@
+# A pipe between a download running in the reactor and a parser running
+# in a thread.
+#
+# The reactor side writes the received data, the parser thread reads it
+# as a file. When the parser falls behind the transfer is paused, so the
+# buffer stays small no matter how big the file is.
+#
+import threading
+from collections import deque
+from twisted.internet import reactor
+
+HIGH_WATER = 4 * 1024 * 1024
+LOW_WATER = 1024 * 1024
+
+class StreamPipe:
+	def __init__(self, highWater=HIGH_WATER, lowWater=LOW_WATER):
+		self.highWater = highWater
+		self.lowWater = lowWater
+		self.cond = threading.Condition()
+		self.chunks = deque()
+		self.size = 0
+		self.received = 0
+		self.eof = False
+		self.closed = False
+		self.failure = None
+		# anything with pauseProducing/resumeProducing/stopProducing
+		self.producer = None
+		self.paused = False
+
+	# Called from the reactor thread
+	def write(self, data):
+		if not data:
+			return
+		self.cond.acquire()
+		try:
+			if self.closed:
+				return
+			self.chunks.append(data)
+			self.size += len(data)
+			self.received += len(data)
+			pause = (self.size > self.highWater) and not self.paused and (self.producer is not None)
+			if pause:
+				self.paused = True
+			self.cond.notify()
+		finally:
+			self.cond.release()
+		if pause:
+			self.producer.pauseProducing()
+
+	def finish(self):
+		'No more data will be written'
+		self.cond.acquire()
+		try:
+			self.eof = True
+			self.cond.notify()
+		finally:
+			self.cond.release()
+
+	def fail(self, failure):
+		'The transfer broke down, the reader gets an IOError'
+		self.cond.acquire()
+		try:
+			self.failure = failure
+			self.eof = True
+			self.cond.notify()
+		finally:
+			self.cond.release()
+
+	def close(self):
+		'Reader is done, possibly early. Stops the transfer if still running.'
+		self.cond.acquire()
+		try:
+			stop = not self.eof and (self.producer is not None)
+			self.closed = True
+			self.eof = True
+			self.chunks.clear()
+			self.size = 0
+		finally:
+			self.cond.release()
+		if stop:
+			self.producer.stopProducing()
+
+	# Called from the parser thread
+	def read(self, size=-1):
+		self.cond.acquire()
+		try:
+			while not self.chunks and not self.eof:
+				self.cond.wait()
+			if not self.chunks:
+				if self.failure is not None:
+					raise IOError("Download failed: %s" % self.failure.getErrorMessage())
+				return ''
+			if size < 0:
+				size = self.size
+			result = []
+			count = 0
+			while self.chunks and count < size:
+				data = self.chunks.popleft()
+				if count + len(data) > size:
+					self.chunks.appendleft(data[size - count:])
+					data = data[:size - count]
+				result.append(data)
+				count += len(data)
+			self.size -= count
+			resume = self.paused and (self.size < self.lowWater)
+			if resume:
+				self.paused = False
+		finally:
+			self.cond.release()
+		if resume:
+			reactor.callFromThread(self.producer.resumeProducing)
+		return ''.join(result)
+
+class PipeWriter:
+	"""Write end of a StreamPipe for HTTPDownloader. Closing it does not end
+	the stream, the owner of the transfer decides between finish and fail."""
+	def __init__(self, pipe):
+		self.pipe = pipe
+
+	@property
+	def started(self):
+		return self.pipe.received > 0
+
+	def registerProducer(self, producer):
+		self.pipe.producer = producer
+
+	def write(self, data):
+		self.pipe.write(data)
+
+	def close(self):
+		pass
@@ -3,6 +3,7 @@ import calendar
 import log
 #from pprint import pprint
 from xml.etree.cElementTree import ElementTree, Element, SubElement, tostring, iterparse
+from eventbuffer import EventBuffer
 
 # %Y%m%d%H%M%S
 def quickptime(str):
@@ -24,110 +25,179 @@ def get_time_utc(timestring, fdateparse):
 		print "[XMLTVConverter] get_time_utc error:", e
 		return 0
 
-# Preferred language should be configurable, but for now,
-# we just like Dutch better!
-def get_xml_string(elem, name):
-	r = ''
+# Days before the first of each month in a common year, index 1 is January
+DAYS_BEFORE_MONTH = (0, 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
+
+def days_before_year(year):
+	'Days from 1970-01-01 to January 1st of year'
+	y = year - 1
+	return 365 * (year - 1970) + (y // 4 - y // 100 + y // 400) - 477
+
+class TimestampDecoder:
+	"""Turns XMLTV times like "20240101120000 +0530" into UTC epoch seconds
+	with plain arithmetic. Same results as get_time_utc(s, quickptime),
+	except that seconds are kept and +0530 style offsets are right."""
+	def __init__(self):
+		# "YYYYMMDD": days since the epoch
+		self.days = {}
+		# "+0100": seconds
+		self.offsets = {}
+		# The start of an event is usually the stop of the previous one
+		self.lastString = None
+		self.lastValue = 0
+
+	def dayNumber(self, date):
+		year = int(date[0:4])
+		month = int(date[4:6])
+		day = int(date[6:8])
+		if not (1 <= month <= 12) or not (1 <= day <= 31):
+			raise ValueError, "bad date %s" % date
+		days = days_before_year(year) + DAYS_BEFORE_MONTH[month] + day - 1
+		if (month > 2) and (year % 4 == 0) and ((year % 100 != 0) or (year % 400 == 0)):
+			days += 1
+		self.days[date] = days
+		return days
+
+	def offset(self, zone):
+		'"+0530": 19800 seconds, a zone without a sign or digits counts as UTC'
+		if (len(zone) == 5) and (zone[0] in '+-') and zone[1:].isdigit():
+			seconds = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+			if zone[0] == '-':
+				seconds = -seconds
+		else:
+			seconds = 0
+		self.offsets[zone] = seconds
+		return seconds
+
+	def __call__(self, timestring):
+		if timestring == self.lastString:
+			return self.lastValue
+		try:
+			days = self.days.get(timestring[:8])
+			if days is None:
+				days = self.dayNumber(timestring[:8])
+			value = days * 86400 + int(timestring[8:10]) * 3600 + int(timestring[10:12]) * 60
+			if timestring[12:14].isdigit():
+				value += int(timestring[12:14])
+			zone = timestring[14:].strip()
+			if zone:
+				offset = self.offsets.get(zone)
+				if offset is None:
+					offset = self.offset(zone)
+				#suppose file says +0300 => that means we have to substract 3 hours from localtime to get gmt
+				value -= offset
+		except Exception, e:
+			print "[XMLTVConverter] get_time_utc error:", e
+			return 0
+		self.lastString = timestring
+		self.lastValue = value
+		return value
+
+# ISO 639-1 language to the ISO 639-2 code enigma wants, plus some odd
+# codes seen in the wild. Languages not in here become 'eng'.
+ISO639 = {
+	'en': 'eng', 'de': 'deu', 'da': 'den', 'dk': 'den', 'fr': 'fra',
+	'es': 'spa', 'it': 'ita', 'nl': 'dut', 'ro': 'rum', 'sr': 'srp',
+	'hr': 'hrv', 'pl': 'pol', 'cs': 'cze', 'he': 'heb', 'pt': 'por',
+	'sk': 'slo', 'ar': 'ara', 'hu': 'hun', 'ja': 'jpn', 'et': 'est',
+	'fi': 'fin', 'el': 'gre', 'is': 'ice', 'lb': 'ltz', 'lt': 'lit',
+	'lv': 'lav', 'no': 'nor', 'nb': 'nor', 'ru': 'rus', 'sv': 'swe',
+	'se': 'swe', 'tr': 'tur', 'uk': 'ukr',
+}
+# Programme children that end up in the event
+PROGRAMME_FIELDS = ('title', 'sub-title', 'desc', 'category')
+# Rank of a language that is not in the preference list
+NOT_PREFERRED = 1000
+
+# lang attribute: rank, lower is better. Among equally ranked children
+# the first one wins. We used to just like Dutch better.
+preferredLanguages = {'nl': 0}
+unmappedLanguages = set()
+
+def setPreferredLanguages(languages):
+	'languages is a list, or a string like "nl,en", best first'
+	global preferredLanguages
+	if isinstance(languages, basestring):
+		languages = languages.replace(' ', ',').split(',')
+	preference = {}
+	for lang in languages:
+		lang = lang.strip().lower()
+		if lang and (lang not in preference):
+			preference[lang] = len(preference)
+	preferredLanguages = preference
+
+# (earliest stop, latest start) of the programmes worth importing, None
+# imports everything
+importWindow = None
+
+def setImportWindow(window):
+	global importWindow
+	importWindow = window
+
+def language_code(lang):
+	'ISO 639-2 code for the lang attribute of an element'
 	try:
-		for node in elem.findall(name):
-			txt = node.text
-			lang = node.get('lang', None)
-			if not r:
-				r = txt
-			elif lang == "nl":
-				r = txt
-	except Exception,  e:
-		print "[XMLTVConverter] get_xml_string error:",  e
+		return ISO639[lang]
+	except KeyError:
+		if lang not in unmappedLanguages:
+			unmappedLanguages.add(lang)
+			print "[XMLTVConverter] unmapped language:", lang
+		return 'eng'
+
+def prefer(fields, tag, text, lang):
+	'Keeps (rank, text, lang) in fields[tag] if lang ranks better than what is there'
+	if (not text) or text.isspace():
+		# An empty element never hides one with text
+		return
+	rank = preferredLanguages.get(lang, NOT_PREFERRED)
+	current = fields.get(tag)
+	if (current is None) or (rank < current[0]):
+		fields[tag] = (rank, text, lang)
+
+def get_programme_fields(elem):
+	'''Walks the children of a programme once, returns {tag: (rank, text, lang)}
+	with the preferred title, sub-title, desc and category'''
+	fields = {}
+	preference = preferredLanguages
+	for node in elem:
+		tag = node.tag
+		if tag in PROGRAMME_FIELD_SET:
+			text = node.text
+			if (not text) or text.isspace():
+				# An empty element never hides one with text
+				continue
+			lang = node.get('lang')
+			rank = preference.get(lang, NOT_PREFERRED)
+			current = fields.get(tag)
+			if (current is None) or (rank < current[0]):
+				fields[tag] = (rank, text, lang)
+	return fields
+
+PROGRAMME_FIELD_SET = frozenset(PROGRAMME_FIELDS)
+
+def field_string(fields, tag):
+	field = fields.get(tag)
+	if (field is None) or not field[1]:
+		return ''
+	text = field[1]
 	# Now returning UTF-8 by default, the epgdat/oudeis must be adjusted to make this work.
-	return r.encode('utf-8')
+	if isinstance(text, unicode):
+		return text.encode('utf-8')
+	return text
+
+def get_xml_string(elem, name):
+	fields = {}
+	for node in elem.findall(name):
+		prefer(fields, name, node.text, node.get('lang', None))
+	return field_string(fields, name)
 
 def get_xml_language(elem, name):
-	r = ''
-	try:
-		for node in elem.findall(name):
-			lang = node.get('lang', None)
-			if not r:
-				# ugly, I know ...
-				if lang == 'en':
-					r = 'eng'
-				elif lang == 'de':
-					r = 'deu'
-				elif lang == 'da':
-					r = 'den'
-				elif lang == 'dk':
-					r = 'den'
-				elif lang == 'fr':
-					r = 'fra'
-				elif lang == 'es':
-					r = 'spa'
-				elif lang == 'it':
-					r = 'ita'
-				elif lang == 'nl':
-					r = 'dut'
-				elif lang == 'ro':
-					r = 'rum'
-				elif lang == 'sr':
-					r = 'srp'
-				elif lang == 'hr':
-					r = 'hrv'
-				elif lang == 'pl':
-					r = 'pol'
-				elif lang == 'cs':
-					r = 'cze'
-				elif lang == 'he':
-					r = 'heb'
-				elif lang == 'pt':
-					r = 'por'
-				elif lang == 'sk':
-					r = 'slo'
-				elif lang == 'ar':
-					r = 'ara'
-				elif lang == 'hu':
-					r = 'hun'
-				elif lang == 'ja':
-					r = 'jpn'
-				elif lang == 'da':
-					r = 'dan'
-				elif lang == 'et':
-					r = 'est'
-				elif lang == 'fi':
-					r = 'fin'
-				elif lang == 'el':
-					r = 'gre'
-				elif lang == 'is':
-					r = 'ice'
-				elif lang == 'lb':
-					r = 'ltz'
-				elif lang == 'lt':
-					r = 'lit'
-				elif lang == 'lv':
-					r = 'lav'
-				elif lang == 'no':
-					r = 'nor'
-				elif lang == 'nb':
-					r = 'nor'
-				elif lang == 'pt':
-					r = 'por'
-				elif lang == 'ru':
-					r = 'rus'
-				elif lang == 'sv':
-					r = 'swe'
-				elif lang == 'se':
-					r = 'swe'
-				elif lang == 'tr':
-					r = 'tur'
-				elif lang == 'uk':
-					r = 'ukr'
-				#	
-				# continue list here ...
-				#	
-				else:
-					print "[XMLTVConverter] unmapped language:", lang
-#					r = lang
-					r = 'eng'
-	except Exception,  e:
-		print "[XMLTVConverter] get_xml_string error:",  e
-	return r.encode('utf-8')
+	fields = {}
+	for node in elem.findall(name):
+		prefer(fields, name, node.text, node.get('lang', None))
+	if name in fields:
+		return language_code(fields[name][2])
+	return ''
 
 
 def enumerateProgrammes(fp):
@@ -140,56 +210,169 @@ def enumerateProgrammes(fp):
 			# Throw away channel elements, save memory
 			elem.clear()
 
+# Bounds of one batch of events for the same services
+BATCH_EVENTS = 500
+BATCH_BYTES = 262144
+
+def eventBuffer(events):
+	'events in an EventBuffer, to keep them or to send them elsewhere'
+	buffer = EventBuffer()
+	buffer.extend(events)
+	return buffer
+
+def batchEvents(items, maxEvents=BATCH_EVENTS, maxBytes=BATCH_BYTES):
+	"""Turns the (services, event) items of a parser iterator into
+	(services, [event, ...]) batches of consecutive events for the same
+	services. None items are passed on, the pending batch is kept.
+	The batches are short lived, those who keep events make an
+	EventBuffer of them."""
+	services = None
+	batch = []
+	append = batch.append
+	size = 0
+	for item in items:
+		if item is None:
+			yield None
+			continue
+		current, event = item
+		if (current is not services and current != services) or (len(batch) >= maxEvents) or (size >= maxBytes):
+			if batch:
+				yield services, batch
+			services = current
+			batch = []
+			append = batch.append
+			size = 0
+		append(event)
+		size += len(event[2]) + len(event[4])
+	if batch:
+		yield services, batch
+
+def logSkipped(outOfWindow, unknownChannels):
+	'unknownChannels maps the channel attribute to the number of programmes skipped'
+	if outOfWindow:
+		print>>log, "[XMLTVConverter] Skipped %d programmes outside the import window" % outOfWindow
+	if unknownChannels:
+		names = sorted(unknownChannels.keys())
+		if len(names) > 10:
+			names = names[:10] + ['...']
+		print>>log, "[XMLTVConverter] Skipped %d programmes of %d unknown channels: %s" % (
+			sum(unknownChannels.values()), len(unknownChannels), ', '.join(names))
 
 class XMLTVConverter:
 	def __init__(self, channels_dict, category_dict, dateformat = '%Y%m%d%H%M%S %Z'):
 	    self.channels = channels_dict
 	    self.categories = category_dict
+	    # channel attribute as found in the file: services, or None
+	    self.channelLookup = {}
+	    # channel attribute: number of programmes skipped
+	    self.unknownChannels = {}
+	    self.window = importWindow
+	    # programmes skipped for ending before or starting after the window
+	    self.outOfWindow = 0
+	    # Leaves logging to the caller, e.g. sharding.py parses many chunks
+	    self.quiet = False
 	    if dateformat.startswith('%Y%m%d%H%M%S'):
 		    self.dateParser = quickptime
+		    self.parseTime = TimestampDecoder()
 	    else:
 		    self.dateParser = lambda x: time.strptime(x, dateformat)
+		    self.parseTime = lambda x: get_time_utc(x, self.dateParser)
+
+	def lookupChannel(self, channel):
+		'Returns the services for the channel attribute of a programme, None if unknown'
+		try:
+			services = self.channelLookup[channel]
+		except KeyError:
+			# first time this id is seen, lowercase it once
+			key = channel.lower()
+			services = self.channels.get(key)
+			if (services is None) and isinstance(key, str):
+				try:
+					# the channel dict may hold unicode keys
+					services = self.channels.get(key.decode('utf-8'))
+				except UnicodeDecodeError:
+					pass
+			self.channelLookup[channel] = services
+		if services is None:
+			self.unknownChannels[channel] = self.unknownChannels.get(channel, 0) + 1
+		return services
+
+	def logSkipped(self):
+		if not self.quiet:
+			logSkipped(self.outOfWindow, self.unknownChannels)
+			self.outOfWindow = 0
+			self.unknownChannels = {}
 
 	def enumFile(self, fileobj):
-		print>>log, "[XMLTVConverter] Enumerating event information"
-		lastUnknown = None
+		if not self.quiet:
+			print>>log, "[XMLTVConverter] Enumerating event information"
 		# there is nothing no enumerate if there are no channels loaded
 		if not self.channels:
 			return
-		for elem in enumerateProgrammes(fileobj):
-			channel = elem.get('channel')
-			channel = channel.lower()
-			if not channel in self.channels:
-				if lastUnknown!=channel:
-					print>>log, "Unknown channel: ", channel
-					lastUnknown=channel
-				# return a None object to give up time to the reactor.
-				yield None
+		# Only start tags are reported, one event per element like the end
+		# tags before. The channel is looked up as soon as a programme
+		# starts, the programme is complete once the next element of the
+		# top level starts.
+		previous = None
+		services = None
+		for event, elem in iterparse(fileobj, ('start',)):
+			tag = elem.tag
+			if (tag != 'programme') and (tag != 'channel'):
 				continue
-			try:
-				services = self.channels[channel]
-				start = get_time_utc(elem.get('start'), self.dateParser)
-				stop = get_time_utc(elem.get('stop'), self.dateParser)
-				title = get_xml_string(elem, 'title')
-				language = get_xml_language(elem, 'title')   
-				# try/except for EPG XML files with program entries containing <sub-title ... />
-				try:
-					subtitle = get_xml_string(elem, 'sub-title')
-				except:
-					subtitle = ''
-				# try/except for EPG XML files with program entries containing <desc ... />
-				try:
-					description = get_xml_string(elem, 'desc')
-				except:
-					description = ''
-				category = get_xml_string(elem, 'category')
-				cat_nr = self.get_category(category,  stop-start)
-				# data_tuple = (data.start, data.duration, data.title, data.short_description, data.long_description, data.type, data.language)
-				if not stop or not start or (stop <= start):
-					print "[XMLTVConverter] Bad start/stop time: %s (%s) - %s (%s) [%s]" % (elem.get('start'), start, elem.get('stop'), stop, title)
-				yield (services, (start, stop-start, title, subtitle, description, cat_nr, language))
-			except Exception,  e:
-				print "[XMLTVConverter] parsing event error:", e
+			if previous is not None:
+				if services is not None:
+					yield self.programmeEvent(services, previous)
+				# Throw away what has been read, save memory
+				previous.clear()
+			previous = elem
+			services = None
+			if tag == 'programme':
+				services = self.lookupChannel(elem.get('channel', ''))
+				if services is None:
+					# return a None object to give up time to the reactor.
+					yield None
+		if services is not None:
+			yield self.programmeEvent(services, previous)
+		self.logSkipped()
+
+	def programmeEvent(self, services, elem):
+		'The event of the complete programme elem, None when it lies outside the import window'
+		times = self.programmeTimes(elem.get('start'), elem.get('stop'))
+		if times is None:
+			return None
+		return self.makeEvent(services, times, get_programme_fields(elem))
+
+	def programmeTimes(self, startattr, stopattr):
+		'(start, stop) of a programme, None when it lies outside the import window'
+		start = self.parseTime(startattr)
+		stop = self.parseTime(stopattr)
+		window = self.window
+		if (window is not None) and stop and ((stop < window[0]) or (start > window[1])):
+			self.outOfWindow += 1
+			return None
+		return start, stop
+
+	def makeEvent(self, services, times, fields):
+		'times as returned by programmeTimes, fields by get_programme_fields'
+		try:
+			start, stop = times
+			title = field_string(fields, 'title')
+			if 'title' in fields:
+				# the language of the title that was picked
+				language = language_code(fields['title'][2])
+			else:
+				language = ''
+			subtitle = field_string(fields, 'sub-title')
+			description = field_string(fields, 'desc')
+			category = field_string(fields, 'category')
+			cat_nr = self.get_category(category,  stop-start)
+			# data_tuple = (data.start, data.duration, data.title, data.short_description, data.long_description, data.type, data.language)
+			if not stop or not start or (stop <= start):
+				print "[XMLTVConverter] Bad start/stop time: %s - %s [%s]" % (start, stop, title)
+			return (services, (start, stop-start, title, subtitle, description, cat_nr, language))
+		except Exception,  e:
+			print "[XMLTVConverter] parsing event error:", e
+			return None
 
 	def get_category(self,  str,  duration):
 		if (not str) or (type(str) != type('str')):
@@ -202,3 +385,57 @@ class XMLTVConverter:
 			elif len(category) > 0:
 				return category
 		return 0
+
+if __name__ == '__main__':
+	# Microbenchmark of the timestamp decoding, and a check that it agrees
+	# with quickptime + timegm
+	import timeit
+	import random
+	samples = []
+	for i in xrange(20000):
+		t = 946684800 + random.randint(0, 40 * 365 * 86400) // 60 * 60
+		zone = random.choice(('+0000', '+0100', '+0200', '-0500', '+0300'))
+		samples.append(time.strftime('%Y%m%d%H%M%S', time.gmtime(t)) + ' ' + zone)
+	decoder = TimestampDecoder()
+	for sample in samples:
+		if decoder(sample) != get_time_utc(sample, quickptime):
+			print "Mismatch:", sample, decoder(sample), get_time_utc(sample, quickptime)
+	print "+0530:", decoder('20240101120000 +0530') == calendar.timegm((2024, 1, 1, 6, 30, 0))
+	print "29 Feb:", decoder('20240229120000 +0000') == calendar.timegm((2024, 2, 29, 12, 0, 0))
+	# A realistic schedule: consecutive programmes on a few channels,
+	# every start is the stop of the previous programme
+	schedule = []
+	for channel in xrange(50):
+		t = 1704067200 + random.randint(0, 3600) // 60 * 60
+		zone = random.choice(('+0000', '+0100', '+0200'))
+		previous = time.strftime('%Y%m%d%H%M%S', time.gmtime(t)) + ' ' + zone
+		for i in xrange(400):
+			t += random.randint(1, 24) * 300
+			stop = time.strftime('%Y%m%d%H%M%S', time.gmtime(t)) + ' ' + zone
+			schedule.append((previous, stop))
+			previous = stop
+	def old():
+		for start, stop in schedule:
+			get_time_utc(start, quickptime)
+			get_time_utc(stop, quickptime)
+	def new():
+		decode = TimestampDecoder()
+		for start, stop in schedule:
+			decode(start)
+			decode(stop)
+	def unchained():
+		# stop and start differ, so only the day and offset caches help
+		decode = TimestampDecoder()
+		for start, stop in schedule:
+			decode(start)
+			decode.lastString = None
+			decode(stop)
+			decode.lastString = None
+	n = 5
+	told = min(timeit.repeat(old, number=1, repeat=n))
+	tnew = min(timeit.repeat(new, number=1, repeat=n))
+	tunchained = min(timeit.repeat(unchained, number=1, repeat=n))
+	events = len(schedule)
+	print "quickptime + timegm      %6.2f us/event" % (told * 1e6 / events)
+	print "decoder, start != stop   %6.2f us/event  %.1fx" % (tunchained * 1e6 / events, told / tunchained)
+	print "decoder                  %6.2f us/event  %.1fx" % (tnew * 1e6 / events, told / tnew)
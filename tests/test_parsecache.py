@@ -0,0 +1,59 @@
+#
+# Replaying parsed sources for imports with a later window.
+# Run with: python -m unittest discover tests
+#
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'EPGImport'))
+
+import parsecache
+
+DAY = parsecache.DAY
+NOON = 19723 * DAY + DAY / 2
+
+def programmes(first, count):
+	return [(first + i * 900, 900, 'Title %d' % i, '', 'Description', 0, 'dut') for i in xrange(count)]
+
+class ParseCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+		self.cache = parsecache.ParseCache(self.path)
+
+	def tearDown(self):
+		shutil.rmtree(self.path, ignore_errors=True)
+
+	def record(self, window, events):
+		parsed = parsecache.dayWindow(window)
+		batches = [(['1:0:1:1:1:1:C00000:0:0:0:'], [e for e in events if parsecache.within([e], parsed)])]
+		return list(self.cache.record('source', parsed, window, iter(batches)))
+
+	def testLaterWindowOfTheSameDayReplays(self):
+		events = programmes(NOON - DAY, 4 * 96)
+		window = (NOON - 3600, NOON + 6 * 3600)
+		passed = self.record(window, events)
+		self.assertEqual(passed[0][1], [e for e in events if (e[0] <= window[1]) and (e[0] + e[1] >= window[0])])
+		later = (window[0] + 1800, window[1] + 1800)
+		replayed = self.cache.replay('source', later)
+		self.assertNotEqual(replayed, None)
+		replayed = list(replayed)
+		self.assertEqual(len(replayed), 1)
+		self.assertEqual(replayed[0][1].tuples(), [e for e in events if (e[0] <= later[1]) and (e[0] + e[1] >= later[0])])
+
+	def testNextDayMisses(self):
+		window = (NOON - 3600, NOON + 6 * 3600)
+		self.record(window, programmes(NOON - DAY, 4 * 96))
+		self.assertEqual(self.cache.replay('source', (window[0] + DAY, window[1] + DAY)), None)
+
+	def testFailedParseIsNotCached(self):
+		window = (NOON - 3600, NOON + 6 * 3600)
+		parsed = parsecache.dayWindow(window)
+		batches = [(['1:0:1:1:1:1:C00000:0:0:0:'], programmes(NOON, 4))]
+		list(self.cache.record('source', parsed, window, iter(batches), lambda: True))
+		self.assertEqual(self.cache.replay('source', window), None)
+
+if __name__ == '__main__':
+	unittest.main()
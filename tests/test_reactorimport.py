@@ -0,0 +1,93 @@
+#
+# An import on the reactor path, the one taken on boxes without threads
+# (DreamOS), from a gzip'ed local source that an external gzip unpacks.
+# Run with: python -m unittest discover tests
+#
+import os
+import sys
+import gzip
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'EPGImport'))
+
+try:
+	from twisted.internet import reactor
+except ImportError:
+	reactor = None
+
+CHANNELS = 20
+PROGRAMMES = 700
+
+class FakeEPGCache:
+	def __init__(self):
+		self.events = []
+	def importEvents(self, services, events):
+		self.events.extend(events)
+
+def timestamp(t):
+	return time.strftime('%Y%m%d%H%M%S +0000', time.gmtime(t))
+
+def writeSource(path):
+	channels = open(os.path.join(path, 'channels.xml'), 'w')
+	channels.write('<channels>\n')
+	for c in xrange(CHANNELS):
+		channels.write('<channel id="ch%d.nl">1:0:1:%X:1:1:C00000:0:0:0:</channel>\n' % (c, c + 1))
+	channels.write('</channels>\n')
+	channels.close()
+	start = int(time.time()) // 3600 * 3600
+	f = gzip.open(os.path.join(path, 'epg.xml.gz'), 'wb')
+	f.write('<?xml version="1.0" encoding="UTF-8"?>\n<tv>\n')
+	for c in xrange(CHANNELS):
+		for i in xrange(PROGRAMMES):
+			t = start + i * 900
+			f.write('<programme start="%s" stop="%s" channel="ch%d.nl"><title lang="nl">Titel %d</title>'
+				'<desc lang="nl">Beschrijving %d</desc></programme>\n' % (timestamp(t), timestamp(t + 900), c, i, i))
+	f.write('</tv>\n')
+	f.close()
+	sources = open(os.path.join(path, 'sources.xml'), 'w')
+	sources.write('<sources><sourcecat sourcecatname="Test"><source type="gen_xmltv" channels="%s">'
+		'<description>Test</description><url>%s</url></source></sourcecat></sources>\n' %
+		(os.path.join(path, 'channels.xml'), os.path.join(path, 'epg.xml.gz')))
+	sources.close()
+
+class ReactorImportTest(unittest.TestCase):
+	def setUp(self):
+		if reactor is None:
+			self.skipTest("twisted is not installed")
+		self.path = tempfile.mkdtemp()
+		writeSource(self.path)
+
+	def tearDown(self):
+		shutil.rmtree(self.path, ignore_errors=True)
+
+	def testImportEndsInCloseImport(self):
+		import compression
+		import EPGConfig
+		import EPGImport
+		EPGImport.useThreads = lambda: False
+		# No caches, every import parses
+		EPGImport.CACHE_LOCATIONS = ()
+		compression.USE_EXTERNAL = True
+		epgcache = FakeEPGCache()
+		epgimport = EPGImport.EPGImport(epgcache, lambda ref: True)
+		closed = []
+		closeImport = epgimport.closeImport
+		def close():
+			closed.append(epgimport.eventCount)
+			closeImport()
+		epgimport.closeImport = close
+		epgimport.onDone = lambda reboot=False, epgfile=None: reactor.stop()
+		epgimport.sources = list(EPGConfig.enumSourcesFile(os.path.join(self.path, 'sources.xml'), filter=None))
+		timeout = reactor.callLater(60, reactor.stop)
+		reactor.callWhenRunning(epgimport.beginImport, longDescUntil=time.time() + 5 * 24 * 3600)
+		reactor.run()
+		self.assertTrue(timeout.active(), "import did not finish")
+		timeout.cancel()
+		self.assertEqual(closed, [CHANNELS * PROGRAMMES])
+		self.assertEqual(len(epgcache.events), CHANNELS * PROGRAMMES)
+
+if __name__ == '__main__':
+	unittest.main()